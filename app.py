@@ -1,39 +1,40 @@
+import click
+import hashlib
+import json
 import os
+import queue
 
-from flask import Flask, flash, redirect, render_template, request, session , url_for, send_file
-from flask_session import Session
-from flask_sqlalchemy import SQLAlchemy
-from tempfile import mkdtemp
+from flask import Flask, Response, flash, jsonify, redirect, render_template, request, session , stream_template, url_for, send_file
 from werkzeug.security import check_password_hash, generate_password_hash
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from dotenv import load_dotenv
 import psycopg2
 import psycopg2.extras
 
-import yfinance as yf
+# Only light modules are imported here. The analytics stack (pandas, numpy,
+# matplotlib, yfinance, pypfopt/cvxpy) is loaded on first use, so worker
+# startup and pages like /login don't pay for it.
 
-# 
-import numpy as np
-import pandas as pd
-from io import BytesIO
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-import matplotlib.pyplot as plt
-plt.style.use('ggplot')
-plt.switch_backend('Agg')
-import base64
 
-# Portfolio Opt
-from pypfopt.efficient_frontier import EfficientFrontier
-from pypfopt import risk_models
-from pypfopt import expected_returns
-from pypfopt.discrete_allocation import DiscreteAllocation, get_latest_prices
-
-
-from helpers import login_required, lookup, usd
+# load the .env file (before helpers reads its cache settings)
+load_dotenv()
 
+import charts
+import db
+import metrics
+import migrations
+import profiler
+import sessions
+import strategies
+import trades
+import valuations
+from charts import store as chart_store
+from db import get_db
+from helpers import api_login_required, login_required, lookup, lookup_many, usd
+from symbols import store as symbol_store
+from jobs import queue as job_queue
+from pricefeed import feed as price_feed
 
-# load the .env file
-load_dotenv()
 
 # Configure application
 app = Flask(__name__)
@@ -42,65 +43,84 @@ app = Flask(__name__)
 app.jinja_env.filters["usd"] = usd
 
 
-# Configure session to use filesystem (instead of signed cookies)
+# Configure session (SESSION_BACKEND: cookie, database or filesystem)
 app.config['SESSION_PERMANENT'] = False
-app.config['SESSION_TYPE'] = 'filesystem'
-Session(app)
-
-
-# Database
-url = os.getenv("DATABASE_URL")
-connection = psycopg2.connect(url)
-
-# Setup tables
-with connection:
-    with connection.cursor() as cursor:
-        cursor.execute("""
-                       CREATE TABLE IF NOT EXISTS users (
-                        id SERIAL PRIMARY KEY NOT NULL,
-                        username TEXT NOT NULL, 
-                        hash TEXT NOT NULL, 
-                        cash NUMERIC NOT NULL DEFAULT 10000.00
-                        );
-                    """)
-
-#with connection:
- #   with connection.cursor() as cursor:
-  #      cursor.execute("""
-   #                    CREATE UNIQUE INDEX username On users (username);
-     #               """)
-
-with connection:
-    with connection.cursor() as cursor:
-        cursor.execute("""
-                       CREATE TABLE IF NOT EXISTS transactions (
-                       transaction_id SERIAL PRIMARY KEY NOT NULL,
-                       user_id INTEGER NOT NULL, 
-                       action TEXT NOT NULL,
-                       symbol TEXT NOT NULL,
-                       shares INTEGER NOT NULL,
-                       price REAL NOT NULL,
-                       datetime TIMESTAMP,
-                       FOREIGN KEY (user_id) REFERENCES users(id)
-                        );
-                    """)
-        
-with connection:
-    with connection.cursor() as cursor:
-        cursor.execute("""
-                       CREATE TABLE IF NOT EXISTS balance (
-                       user_id INTEGER NOT NULL,
-                       symbol TEXT NOT NULL, 
-                       shares INTEGER NOT NULL,
-                       total_value REAL NOT NULL,
-                       FOREIGN KEY (user_id) REFERENCES users(id)
-                        );
-                    """)
+sessions.init_app(app)
+
+
+# request latency and query counts, served on /metrics
+metrics.init_app(app)
+
+# opt-in sampling profiler (PROFILE_TOKEN / PROFILE_SAMPLE_RATE)
+profiler.init_app(app)
+
+# Database (connections are opened on first use)
+db.init_app(app)
+
+# symbol metadata mirror, loaded on first lookup
+symbol_store.init_app(db.pool)
+
+# optimisation jobs
+job_queue.init_app(db.pool)
+
+
+@app.cli.command("init-db")
+def init_db():
+    """Create or upgrade the database schema"""
+    with db.pool.connection() as connection:
+        migrations.migrate(connection)
+    click.echo(f"database at schema version {migrations.MIGRATIONS[-1][0]}")
+
+
+@app.cli.command("sweep-sessions")
+def sweep_sessions():
+    """Delete expired database sessions"""
+    with db.pool.connection() as connection:
+        with connection:
+            with connection.cursor() as cursor:
+                count = sessions.sweep(cursor)
+    click.echo(f"deleted {count} expired sessions")
+
+
+@app.cli.command("sweep-charts")
+@click.option("--days", type=float, help="Delete charts not saved for this many days (default CHART_MAX_AGE)")
+def sweep_charts(days):
+    """Delete charts nobody has saved recently"""
+    count = chart_store.sweep(None if days is None else days * 24 * 60 * 60)
+    click.echo(f"deleted {count} old charts")
+
+
+@app.cli.command("precompute")
+@click.option("--year", "years", multiple=True, type=int, help="Starting year to build (repeatable)")
+def precompute(years):
+    """Rebuild the universe matrices, e.g. nightly from cron"""
+    from universe import universe
+
+    starts = [f"{year}-1-1" for year in years] or universe.starts()
+    for start in starts:
+        universe.build(start)
+        click.echo(f"built universe since {start}")
+
+
+@app.cli.command("snapshot")
+@click.option("--day", type=click.DateTime(["%Y-%m-%d"]), help="Day to record (default today)")
+def snapshot(day):
+    """Record every user's portfolio value, e.g. daily from cron after the close"""
+    day = day.date() if day else date.today()
+    with db.pool.connection() as connection:
+        count = valuations.snapshot(connection, day)
+    click.echo(f"valued {count} users on {day}")
 
 
 @app.after_request
 def after_request(response):
-    """Ensure responses aren't cached"""
+    """
+    Pages are per-user and carry flash messages, so by default they are not
+    cached. Routes that can be cached (charts, the JSON API) set their own
+    Cache-Control, which is left alone.
+    """
+    if "Cache-Control" in response.headers:
+        return response
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     response.headers["Expires"] = 0
     response.headers["Pragma"] = "no-cache"
@@ -112,7 +132,7 @@ def index():
     """Show portfolio of stocks"""
 
     # get stocks held by user
-    with connection:
+    with get_db() as connection:
         with connection.cursor(cursor_factory = psycopg2.extras.RealDictCursor) as cursor:
             cursor.execute(
                 "SELECT * FROM balance WHERE user_id = %s;", 
@@ -122,20 +142,31 @@ def index():
             )
             stocks = cursor.fetchall()
 
+    # price every holding in one batch
+    quotes = lookup_many([stock['symbol'] for stock in stocks])
+
     # create array to loop through in index.html
     display_stocks = []
     total_total = 0
     for stock in stocks:
         symbol = (stock['symbol']).upper()
-        name = lookup(stock['symbol'])['name']
+        quote = quotes.get(symbol)
         shares = stock['shares']
-        price = lookup(stock['symbol'])['price']
         total_value = stock['total_value']
         total_total += float(stock['total_value'])
+
+        # a symbol that failed to look up still shows its position
+        if quote is None:
+            name = symbol
+            price = 'N/A'
+        else:
+            name = quote['name']
+            price = usd(quote['price'])
+
         display_stocks.append({'symbol': symbol,
                             'name': name,
                             'shares': shares,
-                            'price': usd(price),
+                            'price': price,
                             'total_value': usd(total_value),
                             'total_total': usd(total_total)})
         
@@ -145,7 +176,7 @@ def index():
     # if we don't have a portfolio yet skip the next few lines
     # if display_stocks is not empty execute the following and get cash amount
     #if display_stocks:
-    with connection:
+    with get_db() as connection:
         with connection.cursor(cursor_factory = psycopg2.extras.RealDictCursor) as cursor:
             cursor.execute(
                 "SELECT cash FROM users WHERE id = %s;", 
@@ -157,11 +188,96 @@ def index():
 
     grand_total = total_total + cash
 
+    # value at the last two snapshots, for the change since the last close
+    last_close = None
+    change = None
+    snapshots = valuations.latest(get_db(), session["user_id"])
+    if snapshots:
+        last_close = snapshots[0]
+        if len(snapshots) > 1 and snapshots[1]['total']:
+            change = float(snapshots[0]['total'] / snapshots[1]['total'] - 1)
 
     return render_template("index.html",
                             display_stocks=display_stocks,
                             cash=usd(cash),
-                            grand_total=usd(grand_total))
+                            grand_total=usd(grand_total),
+                            last_close=last_close,
+                            change=change)
+
+
+# seconds between keepalive comments on an idle price stream
+PRICE_STREAM_KEEPALIVE = 20
+
+
+@app.route("/prices/stream")
+@login_required
+def price_stream():
+    """Server-sent events with price updates for the symbols the user holds"""
+
+    with get_db() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT upper(symbol) FROM balance WHERE user_id = %s;", [session["user_id"]])
+            symbols = [row[0] for row in cursor.fetchall()]
+
+    if not symbols:
+        return Response(status=204)
+
+    def stream():
+        # one shared poller feeds every open stream
+        subscription = price_feed.subscribe(symbols)
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    updates = subscription.get(timeout=PRICE_STREAM_KEEPALIVE)
+                except queue.Empty:
+                    # keeps proxies from closing the idle connection
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {json.dumps(updates)}\n\n"
+        finally:
+            price_feed.unsubscribe(subscription)
+
+    response = Response(stream(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+# periods selectable on /performance, in days (None for everything)
+PERFORMANCE_PERIODS = {'1m': 31, '3m': 92, '1y': 366, 'all': None}
+
+
+@app.route("/performance")
+@login_required
+def performance():
+    """Show the portfolio's value over time from the daily snapshots"""
+
+    period = request.args.get("period", "1y")
+    if period not in PERFORMANCE_PERIODS:
+        period = "1y"
+    days = PERFORMANCE_PERIODS[period]
+    since = date.today() - timedelta(days=days) if days else None
+
+    snapshots = valuations.history(get_db(), session["user_id"], since)
+
+    # the chart key is a content hash, so an unchanged history reuses its render
+    image = None
+    if snapshots:
+        image = url_for('chart_png', key=chart_store.save({
+            'title': 'Portfolio Value',
+            'xlabel': 'Date',
+            'ylabel': 'Value ($)',
+            'dates': [str(snapshot['day']) for snapshot in snapshots],
+            'lines': [{'label': 'Total', 'values': [float(snapshot['total']) for snapshot in snapshots]},
+                      {'label': 'Holdings', 'values': [float(snapshot['holdings']) for snapshot in snapshots]}],
+        }))
+
+    return render_template("performance.html",
+                            snapshots=snapshots,
+                            image=image,
+                            period=period,
+                            periods=PERFORMANCE_PERIODS)
 
 
 @app.route("/buy", methods=["GET", "POST"])
@@ -180,7 +296,8 @@ def buy():
         symbol = request.form.get("symbol")
 
         # ensure symbol exists
-        if (lookup(symbol) is None):
+        stock = lookup(symbol)
+        if (stock is None):
             flash('This symbol does not exist', 'danger')
             return render_template("buy.html")
 
@@ -202,119 +319,168 @@ def buy():
             return render_template("buy.html")
 
 
-        # get stock info and num of shares
-        stock = lookup(symbol)
+        # get num of shares
         shares = int(request.form.get("shares"))
 
-        # get cash of the user
-        with connection:
-            with connection.cursor(cursor_factory = psycopg2.extras.RealDictCursor) as cursor:
-                cursor.execute(
-                    "SELECT cash FROM users WHERE id = %s;", 
-                    [
-                        session["user_id"]
-                    ]
-                )
-                cash = float(cursor.fetchall()[0]['cash'])
+        # cash check, transaction and position update in one round trip
+        try:
+            trades.buy(get_db(), session["user_id"], symbol, shares, float(stock["price"]))
+        except trades.TradeError as error:
+            flash(str(error), 'danger')
+            return render_template("buy.html")
 
-        # total_value of transaction
-        total_value = (float(stock["price"]) * shares)
+        return redirect("/")
 
-        # check if user has enough money for transaction
-        if (cash < total_value):
-            flash('Insufficient cash funds', 'danger')
-            return render_template("buy.html")
+    else:
+        return render_template("buy.html")
 
-        # caculate remaining cash
-        money_left = cash - (total_value)
 
-        # update transactions table
-        now = datetime.now()
-        with connection:
-            with connection.cursor() as cursor:
-                cursor.execute(
-                    "INSERT INTO transactions (user_id, action, symbol, shares, price, datetime) VALUES (%s, %s, %s, %s, %s, %s);",
-                   [
-                        session["user_id"], "purchase", symbol, shares, stock["price"], now
-                   ]
-                )
+# rows per history page
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
 
-        # update users table
-        with connection:
-            with connection.cursor() as cursor:
-                cursor.execute(
-                    "UPDATE users SET cash = %s WHERE id = %s;", 
-                    [
-                        money_left, session["user_id"]
-                    ]
-                )
 
-        symbol = symbol.lower()
+@app.route("/history")
+@login_required
+def history():
+    """Show history of transactions, one page at a time (newest first)"""
 
-        # update balance table
-        # check if user already holds any of this stock
-        with connection:
-            with connection.cursor(cursor_factory = psycopg2.extras.RealDictCursor) as cursor:
-                cursor.execute(
-                    "SELECT * FROM balance WHERE user_id = %s AND symbol = %s;", 
-                    [
-                        session["user_id"], symbol
-                    ]
-                )
-                
-                count = cursor.rowcount
+    try:
+        filters, limit, before = _history_page_args()
+    except ValueError as error:
+        flash(str(error), 'danger')
+        return redirect(url_for('history'))
 
-        # if no previous stock
-        if count == 0:
-            # insert new row        
-            with connection:
-                with connection.cursor() as cursor:
-                    cursor.execute(
-                        "INSERT INTO balance (user_id, symbol, shares, total_value) VALUES (%s, %s, %s, %s);",
-                       [
-                            session["user_id"], symbol, shares, total_value
-                       ]
-                    )
-
-       # else if row already exists update its values
-        else:
-            with connection:
-                with connection.cursor() as cursor:
-                    cursor.execute(
-                        "UPDATE balance SET shares = shares + %s, total_value = total_value + %s WHERE user_id = %s AND symbol = %s;",
-                       [
-                            shares, total_value, session["user_id"], symbol
-                       ]
-                    )
+    transactions, next_page = _history_page(session["user_id"], filters, limit, before)
 
-        return redirect("/")
+    # formatting
+    for transaction in transactions:
+        _format_transaction(transaction)
 
-    else:
-        return render_template("buy.html")
+    return render_template("history.html",
+                           transactions=transactions,
+                           filters=filters,
+                           limit=limit,
+                           next_page=next_page)
 
 
-@app.route("/history")
+@app.route("/history/export")
 @login_required
-def history():
-    """Show history of transactions"""
+def history_export():
+    """Stream the full (filtered) history without holding it in memory"""
+
+    try:
+        filters = _history_filters()
+    except ValueError as error:
+        flash(str(error), 'danger')
+        return redirect(url_for('history'))
+
+    sql, params = _history_query(session["user_id"], filters)
+
+    def transactions():
+        # named cursor = server-side cursor, rows arrive in batches of itersize
+        with get_db() as connection:
+            with connection.cursor('history_export', cursor_factory = psycopg2.extras.RealDictCursor) as cursor:
+                cursor.itersize = 1000
+                cursor.execute(sql, params)
+                for transaction in cursor:
+                    yield _format_transaction(transaction)
+
+    return stream_template("history.html",
+                           transactions=transactions(),
+                           filters=filters,
+                           export=True)
+
+
+def _history_filters():
+    # symbol and date range from the query string; ValueError if a date is invalid
+    filters = {'symbol': request.args.get('symbol', '').strip(),
+               'start': request.args.get('start', ''),
+               'end': request.args.get('end', '')}
+    try:
+        for key in ('start', 'end'):
+            if filters[key]:
+                datetime.strptime(filters[key], '%Y-%m-%d')
+    except ValueError:
+        raise ValueError('Dates must be given as YYYY-MM-DD') from None
+    return filters
+
+
+def _history_page_args():
+    # filters, page size and keyset cursor of /history and /api/v1/history;
+    # ValueError (with a message for the user) if any of them is invalid
+    filters = _history_filters()
+
+    try:
+        limit = min(max(int(request.args.get('limit', HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+    except ValueError:
+        raise ValueError('Page size must be a whole number') from None
+
+    # keyset cursor: (datetime, transaction_id) of the last row on the previous page
+    before = None
+    if request.args.get('before'):
+        try:
+            when, transaction_id = request.args.get('before').rsplit('_', 1)
+            before = (datetime.fromisoformat(when), int(transaction_id))
+        except ValueError:
+            raise ValueError('Invalid page') from None
+
+    return filters, limit, before
+
+
+def _history_page(user_id, filters, limit, before=None):
+    # one page of transactions and the cursor of the next one (None on the last page)
+    sql, params = _history_query(user_id, filters, before)
+    sql += " LIMIT %s"
+    params.append(limit + 1)
 
-    with connection:
+    with get_db() as connection:
         with connection.cursor(cursor_factory = psycopg2.extras.RealDictCursor) as cursor:
-            cursor.execute(
-                "SELECT * FROM transactions WHERE user_id = %s;", 
-                [
-                    session["user_id"]
-                ]
-            )
+            cursor.execute(sql, params)
             transactions = cursor.fetchall()
 
-    # formatting
-    for transaction in transactions:
-        transaction['symbol'] = transaction['symbol'].upper()
-        transaction['action'] = transaction['action'].capitalize()
-        transaction['price'] = usd(transaction['price'])
+    # one extra row tells us whether there is another page
+    next_page = None
+    if len(transactions) > limit:
+        transactions = transactions[:limit]
+        last = transactions[-1]
+        next_page = f"{last['datetime'].isoformat()}_{last['transaction_id']}"
+    return transactions, next_page
+
+
+def _history_query(user_id, filters, before=None):
+    # newest first, matching the (user_id, datetime, transaction_id) index
+    conditions = ["user_id = %s"]
+    params = [user_id]
+
+    # rows bought before symbols were stored lower-case keep the case typed
+    if filters['symbol']:
+        conditions.append("lower(symbol) = %s")
+        params.append(filters['symbol'].lower())
 
-    return render_template("history.html", transactions=transactions)
+    if filters['start']:
+        conditions.append("datetime >= %s::date")
+        params.append(filters['start'])
+
+    if filters['end']:
+        conditions.append("datetime < %s::date + 1")
+        params.append(filters['end'])
+
+    if before is not None:
+        conditions.append("(datetime, transaction_id) < (%s, %s)")
+        params.extend(before)
+
+    sql = ("SELECT transaction_id, symbol, action, price, shares, datetime FROM transactions WHERE "
+           + " AND ".join(conditions)
+           + " ORDER BY datetime DESC, transaction_id DESC")
+    return sql, params
+
+
+def _format_transaction(transaction):
+    transaction['symbol'] = transaction['symbol'].upper()
+    transaction['action'] = transaction['action'].capitalize()
+    transaction['price'] = usd(transaction['price'])
+    return transaction
 
 
 @app.route("/login", methods=["GET", "POST"])
@@ -338,7 +504,7 @@ def login():
             return render_template("login.html")
 
         # Query database for username
-        with connection:
+        with get_db() as connection:
             with connection.cursor(cursor_factory = psycopg2.extras.RealDictCursor) as cursor:
                 cursor.execute(
                     "SELECT * FROM users WHERE username = %s;", 
@@ -391,13 +557,14 @@ def quote():
         # get symbol
         symbol = request.form.get("symbol")
 
+        # use lookup to return the stock price
+        stock = lookup(symbol)
+
         # ensure symbol exists
-        if (lookup(symbol) is None):
+        if (stock is None):
             flash('This symbol does not exist', 'danger')
             return render_template("quote.html")
 
-        # use lookup to return the stock price
-        stock = lookup(request.form.get("symbol"))
         stock['symbol'] = symbol.upper()
         stock['price'] = usd(stock['price'])
 
@@ -425,7 +592,7 @@ def register():
             return render_template("register.html")
 
         # query database for username
-        with connection:
+        with get_db() as connection:
             with connection.cursor(cursor_factory = psycopg2.extras.RealDictCursor) as cursor:
                 cursor.execute(
                     "SELECT * FROM users WHERE username = %s;", 
@@ -446,7 +613,7 @@ def register():
             return render_template("register.html")
 
         # store new user in database
-        with connection:
+        with get_db() as connection:
             with connection.cursor() as cursor:
                 cursor.execute(
                     "INSERT INTO users (username, hash) VALUES (%s, %s);", 
@@ -491,79 +658,21 @@ def sell():
             flash('Number of shares must be a whole number', 'danger')
             return render_template("sell.html")
 
-        # check if user actually owns stock
-        with connection:
-            with connection.cursor(cursor_factory = psycopg2.extras.RealDictCursor) as cursor:
-                cursor.execute(
-                    "SELECT * FROM balance WHERE user_id = %s AND symbol = %s AND shares != 0;",
-                    [
-                        session["user_id"], request.form.get('symbol').lower()
-                    ]
-                )
-                count = cursor.rowcount
-                stocks = cursor.fetchall()
-                
-        if count == 0:
-            flash('You do not own any of this stock', 'danger')
-            return render_template("sell.html")
-
-        # check if input number does not exceed stocks owned
-        if int(stocks[0]['shares']) < int(request.form.get('shares')):
-            flash("You do not own that many shares of this stock", 'danger')
+        # get current price
+        stock = lookup(request.form.get('symbol'))
+        if stock is None:
+            flash('This symbol does not exist', 'danger')
             return render_template("sell.html")
 
         shares = int(request.form.get('shares'))
-        price = float((lookup(request.form.get('symbol')))['price'])
-
-        earned = shares * price
-
-        symbol = request.form.get("symbol").lower()
-
-        # update tables
-
-        # update transactions table
-        with connection:
-            with connection.cursor() as cursor:
-                cursor.execute(
-                    "INSERT INTO transactions (user_id, action, symbol, shares, price, datetime) VALUES (%s, %s, %s, %s, %s, %s);",
-                   [
-                        session["user_id"], "sale", symbol, shares, price, datetime.now()
-                   ]
-                )
-
-        # update balance table
-        # if user sold as many shares as he had; drop row
-        if int(stocks[0]['shares']) == shares:
-            with connection:
-                with connection.cursor() as cursor:
-                    cursor.execute(
-                        "DELETE FROM balance WHERE user_id = %s AND symbol = %s;", 
-                        [
-                            session["user_id"], symbol
-                        ]
-                    )
-
-        # else update values
-        else:
-            with connection: 
-                with connection.cursor() as cursor:
-                    cursor.execute(
-                        "UPDATE balance SET shares = shares - %s, total_value = total_value - %s WHERE user_id = %s AND symbol = %s;",
-                        [
-                            shares, earned, session["user_id"], symbol
-                        ]
-                    )
+        price = float(stock['price'])
 
-
-        # update users table
-        with connection:
-            with connection.cursor() as cursor:
-                cursor.execute(
-                    "UPDATE users SET cash = cash + %s WHERE id = %s;", 
-                    [
-                        earned, session["user_id"]
-                    ]
-                )
+        # ownership check, transaction and balance/cash updates in one round trip
+        try:
+            trades.sell(get_db(), session["user_id"], request.form.get('symbol'), shares, price)
+        except trades.TradeError as error:
+            flash(str(error), 'danger')
+            return render_template("sell.html")
 
         # redirect to homepage
         return redirect("/")
@@ -571,7 +680,7 @@ def sell():
     else:
 
         # get stocks held by user
-        with connection:
+        with get_db() as connection:
             with connection.cursor(cursor_factory = psycopg2.extras.RealDictCursor) as cursor:
                 cursor.execute(
                     "SELECT * FROM balance WHERE user_id = %s;", 
@@ -581,10 +690,16 @@ def sell():
                 )
                 stocks = cursor.fetchall()
 
+        # current prices for the dropdown, fetched in one batch
+        quotes = lookup_many([stock['symbol'] for stock in stocks])
+
         display_stocks = []
         for stock in stocks:
             symbol = (stock['symbol']).upper()
-            display_stocks.append({'symbol': symbol})
+            quote = quotes.get(symbol)
+            display_stocks.append({'symbol': symbol,
+                                   'shares': stock['shares'],
+                                   'price': usd(quote['price']) if quote else None})
 
         return render_template("sell.html", stocks=display_stocks)
 
@@ -611,7 +726,7 @@ def deposit():
         cash = float(request.form.get("cash"))
 
         # update users table
-        with connection:
+        with get_db() as connection:
             with connection.cursor() as cursor:
                 cursor.execute(
                     "UPDATE users SET cash = cash + %s WHERE id = %s;", 
@@ -648,7 +763,7 @@ def withdraw():
         withdrawal = float(request.form.get("cash"))
 
         # withrawal must be less or equal to cash held
-        with connection:
+        with get_db() as connection:
             with connection.cursor(cursor_factory = psycopg2.extras.RealDictCursor) as cursor:
                 cursor.execute(
                     "SELECT cash FROM users WHERE id = %s;", 
@@ -663,7 +778,7 @@ def withdraw():
             return render_template("withdraw.html")
 
         # update users table
-        with connection:
+        with get_db() as connection:
             with connection.cursor() as cursor:
                 cursor.execute(
                     "UPDATE users SET cash = cash - %s WHERE id = %s;", 
@@ -679,186 +794,415 @@ def withdraw():
         return render_template("withdraw.html")
     
 
+# longest projection horizon in years
+MAX_HORIZON = 30
+
+
 @app.route("/optimise", methods=["GET", "POST"])
 @login_required
 def optimise():
+    """Queue an optimisation of the user's portfolio"""
 
     if request.method == "POST":
-        
-        # getting the stock held by user 
-        with connection:
+
+        # ensure a starting year was chosen
+        if not request.form.get("year"):
+            flash('Must choose a starting year', 'danger')
+            return redirect(url_for('optimise'))
+
+        # ensure the strategy is one we know
+        objective = request.form.get("objective", "max_sharpe")
+        estimator = request.form.get("estimator", "sample")
+        if objective not in strategies.OBJECTIVES or estimator not in strategies.ESTIMATORS:
+            flash('Unknown optimisation strategy', 'danger')
+            return redirect(url_for('optimise'))
+
+        # a target volatility (in percent) is only used by efficient_risk
+        target = None
+        if objective == 'efficient_risk':
+            try:
+                target = round(float(request.form.get("target")) / 100, 4)
+            except (TypeError, ValueError):
+                flash('Must provide a target volatility', 'danger')
+                return redirect(url_for('optimise'))
+            if target <= 0:
+                flash('Target volatility must be positive', 'danger')
+                return redirect(url_for('optimise'))
+
+        # an optional horizon (in years) to project both portfolios over
+        horizon = request.form.get("horizon")
+        if horizon:
+            if not horizon.isdigit() or not 1 <= int(horizon) <= MAX_HORIZON:
+                flash(f'Horizon must be between 1 and {MAX_HORIZON} years', 'danger')
+                return redirect(url_for('optimise'))
+            horizon = int(horizon)
+        else:
+            horizon = None
+
+# getting the stock held by user 
+        with get_db() as connection:
             with connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
                 cursor.execute(
-                    "SELECT * FROM balance WHERE user_id = %s;",
+                    "SELECT symbol, shares, total_value FROM balance WHERE user_id = %s ORDER BY symbol;",
                     [
                         session["user_id"]
                     ]
                 )
                 stocks = cursor.fetchall()
 
-        tickers_list = []
-        list_of_tickers = []
-        total_total = 0
-        for stock in stocks:
-            ticker = stock['symbol'].upper()
-            shares = stock['shares']
-            total_value = stock['total_value'] # shares * (current) price 
-            total_total += total_value # total_value of all portfolio 
-            tickers_list.append({'ticker': ticker,
-                                 'shares': shares,
-                                 'total_value': usd(total_value)})
-            list_of_tickers.append(ticker)
-
-        # now all the stock names that the users holds should be in the tickers list
-        # get the adj close price since 2018
-        year = str(request.form.get("year"))+'-1-1'
-        data = yf.download(list_of_tickers, year)['Adj Close']
-        # this should be a dataframe with the date as the index, tickers as columns and adj close as the values
-
-        # mean
-        mu = expected_returns.mean_historical_return(data) 
-        # covariance of every stock 
-        S = risk_models.sample_cov(data)
-
-        # Optimising for maximal Sharpe ratio
-        ef = EfficientFrontier(mu, S) # expected returns and covariance matrix as input
-        weights = ef.max_sharpe() # Optimising weights for Sharpe ratio maximization
-
-        clean_weights = ef.clean_weights() # rounds the weights and clips near-zeros => returns a dict _OrderedDict_([('ticker', 0.632), ('ticker2', 0.234)])
-        # convert the OrderedDict to a pandas Series
-        series = pd.Series(clean_weights)
-
-        # turn weights into a number of shares
-        # get total value of current portfolio
-        pf_value = 0
-        for stock in stocks:
-            pf_value += stock['total_value']
+        if not stocks:
+            flash('You need to hold stocks to optimise your portfolio', 'danger')
+            return redirect(url_for('optimise'))
 
-        latest_prices = get_latest_prices(data)
-        da = DiscreteAllocation(clean_weights, latest_prices, total_portfolio_value=pf_value)
-        allocation, leftover = da.greedy_portfolio()
+        # loads the analytics stack on the first optimisation
+        from optimiser import optimise_portfolio
 
-        display_stocks = []
-        for ticker in list_of_tickers:
-            symbol = ticker
-            weight = series[ticker]
-            if ticker in allocation:
-                num = allocation[ticker]
-            else:
-                num = 0
-            display_stocks.append({'symbol': symbol,
-                                'weight': weight,
-                                'shares': num,
-                                })
-
-        # Visualization (Historical Performance of Portfolio ignoring purchase day etc.)
-
-        # calculate old weights
-        old_weights = []
-        for ticker in tickers_list:
-            symbol = ticker['ticker']
-            total_value = ticker['total_value'][1:]
-            weight = float(total_value.replace(',','')) / total_total
-            old_weights.append({'symbol': symbol,
-                                'weight': weight})
-            
-        # apply weights to returns
-        dates = data.index # extract the index (dates) from data to use as index for new dataframe
-        old_portfolio_return = pd.DataFrame({'date': dates})
-        old_portfolio_return.set_index('date')
-
-        for symbol in old_weights:
-
-            close = data.loc[:, symbol['symbol']] 
-            close = close.reset_index(drop=True)
-
-            returns = pd.Series()
-            for i in range(len(close)):
-                if i == 0:
-                    returns[i] = 0
-                else: 
-                    returns[i] = (close[i] - close[i-1]) / close[i-1] 
-
-            weighted_return = symbol['weight'] * returns
-
-            old_portfolio_return[symbol['symbol']] = weighted_return # add the weighted return as a column to the dataframe
-
-        # sum up to single column
-        
-        old_portfolio_return['total_return'] = old_portfolio_return[list_of_tickers].sum(axis=1)
-        # calculate cumulative product
-        old_portfolio_return['cum_prod'] = 1 * (1 + old_portfolio_return["total_return"]).cumprod()
+        # the heavy lifting happens on the job workers
+        params = {'year': int(request.form.get("year")),
+                  'stocks': [dict(stock) for stock in stocks],
+                  'objective': objective,
+                  'estimator': estimator,
+                  'target': target,
+                  'horizon': horizon}
+        # a profiled request gets its optimisation profiled as well
+        job_id = job_queue.submit(session["user_id"], 'optimise', params, optimise_portfolio,
+                                  profile=profiler.active())
 
-        # OPTIMISED PORTFOLIO
+        return redirect(url_for('optimised', job_id=job_id))
 
-        new_portfolio_return = pd.DataFrame({'date': dates})
-        new_portfolio_return.set_index('date')
+    else:
 
-        for key, value in clean_weights.items():
+        year = datetime.today().year
+        years = range(year, FIRST_YEAR - 1, -1)
 
-            close = data.loc[:, key]
-            close = close.reset_index(drop=True)
+        return render_template("optimise.html", years=years, horizons=range(1, MAX_HORIZON + 1),
+                               objectives=strategies.OBJECTIVES,
+                               estimators=strategies.ESTIMATORS)
 
-            returns = pd.Series()
-            for i in range(len(close)):
-                if i == 0:
-                    returns[i] = 0
-                else:
-                    returns[i] = (close[i] - close[i-1]) / close[i-1]
-            weighted_return = value * returns
 
-            new_portfolio_return[key] = weighted_return 
+@app.route("/optimise/status/<job_id>")
+@login_required
+def optimise_status(job_id):
+    """Progress of an optimisation job as JSON"""
 
-        # sum up to single column
-            
-        new_portfolio_return['total_return'] = new_portfolio_return[list_of_tickers].sum(axis=1)
-        # calculate cumulative product
-        new_portfolio_return['cum_prod'] = 1 * (1 + new_portfolio_return["total_return"]).cumprod()
+    job = job_queue.get(job_id, session["user_id"])
+    if job is None:
+        return {'error': 'Unknown job'}, 404
 
+    return {'status': job['status'],
+            'progress': job['progress'],
+            'message': job['message'],
+            'error': job['error']}
 
-        
-        fig = create_figure(old_portfolio_return, new_portfolio_return)
-        pngImage = BytesIO()
-        FigureCanvas(fig).print_png(pngImage)
-        
-        # Encode PNG image to base64 string
-        pngImageB64String = "data:image/png;base64,"
-        pngImageB64String += base64.b64encode(pngImage.getvalue()).decode('utf8')
-
-        return render_template("optimised.html",
-                                display_stocks=display_stocks,
-                                leftover=usd(leftover),
-                                pf_value=usd(pf_value),
-                                image=pngImageB64String
-                                )
-    else:
 
-        year = datetime.today().year
-        years = range(year, 1999, -1)
+# upper bound on points per frontier sweep
+FRONTIER_MAX_POINTS = 200
 
-        return render_template("optimise.html", years=years)
+# earliest starting year offered for optimisations and frontiers
+FIRST_YEAR = 2000
 
-def create_figure(data, data2):
-    fig, ax = plt.subplots()
-    plt.plot(data.date, data.cum_prod, label = 'Old Portfolio') #### 
-    plt.plot(data2.date, data2.cum_prod, label = 'Optimised Portfolio') #### 
-    plt.xlabel('Date')
-    plt.ylabel('Cumulative Returns')
-    plt.title('Comparison')
-    plt.legend()
-    return fig
 
+@app.route("/optimise/frontier")
+@login_required
+def optimise_frontier():
+    """Efficient frontier of the user's holdings as JSON"""
+
+    # starting year and number of points on the curve
+    try:
+        year = int(request.args.get("year", datetime.today().year - 5))
+        points = min(max(int(request.args.get("points", 50)), 2), FRONTIER_MAX_POINTS)
+    except ValueError:
+        return {'error': 'year and points must be whole numbers'}, 400
+    if not FIRST_YEAR <= year <= datetime.today().year:
+        return {'error': f'year must be between {FIRST_YEAR} and {datetime.today().year}'}, 400
+
+    with get_db() as connection:
+        with connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute(
+                "SELECT symbol, shares, total_value FROM balance WHERE user_id = %s ORDER BY symbol;",
+                [
+                    session["user_id"]
+                ]
+            )
+            stocks = cursor.fetchall()
+
+    if len(stocks) < 2:
+        return {'error': 'You need to hold at least two stocks'}, 400
+
+    # loads the analytics stack on first use
+    from optimiser import efficient_frontier
 
-@app.route("/optimised", methods=["GET", "POST"])
+    try:
+        return efficient_frontier({'year': year, 'stocks': stocks}, points)
+    except strategies.StrategyError as error:
+        return {'error': str(error)}, 400
+
+
+@app.route("/optimised/<job_id>")
 @login_required
-def optimised():
-    
-    if request.method == "POST":
+def optimised(job_id):
+    """Show the result of an optimisation job, or its progress while it runs"""
+
+    job = job_queue.get(job_id, session["user_id"])
+    if job is None:
+        flash('This optimisation does not exist', 'danger')
+        return redirect(url_for('optimise'))
+
+    if job['status'] == 'failed':
+        flash(job['error'], 'danger')
+        return redirect(url_for('optimise'))
 
-        return render_template("/")
+    if job['status'] != 'done':
+        return render_template("optimising.html", job=job)
+
+    result = job['result']
+
+    # results persisted before charts got their own endpoint carry the image inline
+    if 'chart' in result:
+        image = url_for('chart_png', key=result['chart'])
     else:
-        
-        return render_template("/optimised")
+        image = result['image']
+
+    projection = result.get('projection')
+    if projection:
+        projection = dict(projection, image=url_for('chart_png', key=projection['chart']))
+
+    # shares held when the optimisation ran, next to the target
+    held = {stock['symbol'].upper(): stock['shares'] for stock in job['params']['stocks']}
+
+    return render_template("optimised.html",
+                            job_id=job_id,
+                            held=held,
+                            can_rebalance='allocation' in result,
+                            display_stocks=result['display_stocks'],
+                            leftover=usd(result['leftover']),
+                            pf_value=usd(result['pf_value']),
+                            image=image,
+                            objective=strategies.OBJECTIVES.get(result.get('objective', 'max_sharpe')),
+                            estimator=strategies.ESTIMATORS.get(result.get('estimator', 'sample')),
+                            projection=projection,
+                            timings=result.get('timings', {})
+                            )
+
+
+@app.route("/optimised/<job_id>/rebalance", methods=["POST"])
+@login_required
+def rebalance(job_id):
+    """Trade the user's holdings to the allocation of an optimisation, as one basket"""
+
+    job = job_queue.get(job_id, session["user_id"])
+    if job is None or job['status'] != 'done' or 'allocation' not in job['result']:
+        flash('This optimisation can not be applied', 'danger')
+        return redirect(url_for('optimise'))
+
+    with get_db() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT symbol, shares FROM balance WHERE user_id = %s;", [session["user_id"]])
+            current = {symbol.upper(): shares for symbol, shares in cursor.fetchall()}
+
+    # the allocation was sized for the holdings at the time; if they have
+    # changed since (including by an earlier rebalance) it no longer applies
+    optimised_for = {stock['symbol'].upper(): stock['shares'] for stock in job['params']['stocks']}
+    if current != optimised_for:
+        flash('Your holdings have changed since this optimisation, please run it again', 'danger')
+        return redirect(url_for('optimised', job_id=job_id))
+
+    # every held symbol gets a target, 0 for the ones the optimiser dropped
+    targets = {symbol: 0 for symbol in current}
+    targets.update({symbol.upper(): shares for symbol, shares in job['result']['allocation'].items()})
+
+    # price the whole basket in one batch
+    quotes = lookup_many(list(targets))
+    missing = [symbol for symbol in targets if quotes.get(symbol) is None]
+    if missing:
+        flash(f'Could not get a price for {", ".join(missing)}, please try again', 'danger')
+        return redirect(url_for('optimised', job_id=job_id))
+
+    try:
+        order = trades.rebalance(get_db(), session["user_id"], targets,
+                                 {symbol: quotes[symbol]['price'] for symbol in targets})
+    except trades.TradeError as error:
+        flash(str(error), 'danger')
+        return redirect(url_for('optimised', job_id=job_id))
+
+    flash(f'Rebalanced with {order["orders"]} orders', 'success')
+    return redirect("/")
+
+
+@app.route("/chart/<key>.png")
+@login_required
+def chart_png(key):
+    """Rendered chart, cacheable forever since the key is its content hash"""
+    return _chart_response(key, 'png')
+
+
+@app.route("/chart/<key>.json")
+@login_required
+def chart_json(key):
+    """Data series behind a chart, for drawing it in the browser"""
+    return _chart_response(key, 'json')
+
+
+def _chart_response(key, kind):
+    if not charts.is_key(key) or chart_store.series(key) is None:
+        return {'error': 'Unknown chart'}, 404
+
+    if kind == 'png':
+        response = Response(chart_store.png(key), mimetype='image/png')
+    else:
+        response = Response(chart_store.series(key), mimetype='application/json')
+
+    response.set_etag(key)
+    response.last_modified = chart_store.modified(key)
+    response.cache_control.private = True
+    response.cache_control.max_age = 365 * 24 * 60 * 60
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+
+# JSON API, version 1
+#
+# Every response carries an ETag derived from the versions of the data it
+# is built from (the user's last transaction id and cash, quote prices, job
+# status) and a Cache-Control header chosen per route. A request whose
+# If-None-Match still matches gets a 304 before the body is built.
+
+# most symbols per /api/v1/quotes request
+API_MAX_QUOTES = 50
+
+
+def _api_response(version, build, max_age=0, immutable=False):
+    etag = hashlib.sha256(repr(version).encode()).hexdigest()[:32]
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+
+    response.set_etag(etag)
+    response.cache_control.private = True
+    if max_age:
+        response.cache_control.max_age = max_age
+        response.cache_control.immutable = immutable or None
+    else:
+        # may be stored, but must be revalidated with the ETag every time
+        response.cache_control.no_cache = True
+    return response
+
+
+@app.route("/api/v1/portfolio")
+@api_login_required
+def api_portfolio():
+    """Holdings at current prices, cash and total value"""
+
+    with get_db() as connection:
+        with connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute(
+                """SELECT users.cash,
+                          (SELECT max(transaction_id) FROM transactions WHERE user_id = users.id) AS last_transaction,
+                          balance.symbol, balance.shares, balance.total_value
+                   FROM users
+                   LEFT JOIN balance ON balance.user_id = users.id
+                   WHERE users.id = %s
+                   ORDER BY balance.symbol;""",
+                [session["user_id"]]
+            )
+            rows = cursor.fetchall()
+
+    cash = float(rows[0]['cash'])
+    holdings = [row for row in rows if row['symbol'] is not None]
+    quotes = lookup_many([row['symbol'] for row in holdings])
+    prices = {symbol: quote and quote['price'] for symbol, quote in quotes.items()}
+
+    def build():
+        stocks = []
+        for row in holdings:
+            symbol = row['symbol'].upper()
+            quote = quotes.get(symbol)
+            stocks.append({'symbol': symbol,
+                           'name': quote['name'] if quote else None,
+                           'shares': row['shares'],
+                           'price': quote['price'] if quote else None,
+                           'value': round(quote['price'] * row['shares'], 2) if quote else None,
+                           'book_value': round(float(row['total_value']), 2)})
+        value = sum(stock['value'] or 0 for stock in stocks)
+        return {'stocks': stocks,
+                'cash': cash,
+                'value': round(value, 2),
+                'total': round(value + cash, 2)}
+
+    return _api_response(('portfolio', rows[0]['last_transaction'], cash, sorted(prices.items())), build)
+
+
+@app.route("/api/v1/quotes")
+@api_login_required
+def api_quotes():
+    """Quotes for ?symbols=AAPL,MSFT"""
+
+    symbols = [symbol.strip().upper() for symbol in request.args.get("symbols", "").split(",") if symbol.strip()]
+    if not symbols:
+        return {'error': 'symbols is required'}, 400
+    if len(symbols) > API_MAX_QUOTES:
+        return {'error': f'At most {API_MAX_QUOTES} symbols per request'}, 400
+
+    quotes = lookup_many(symbols)
+
+    # quotes are cached upstream for QUOTE_CACHE_TTL; clients may reuse them briefly
+    return _api_response(('quotes', sorted((symbol, quote and quote['price']) for symbol, quote in quotes.items())),
+                         lambda: {'quotes': quotes}, max_age=15)
+
+
+@app.route("/api/v1/history")
+@api_login_required
+def api_history():
+    """Transactions, newest first, paged with ?before=<next> like /history"""
+
+    try:
+        filters, limit, before = _history_page_args()
+    except ValueError as error:
+        return {'error': str(error)}, 400
+
+    # transactions are only ever appended, so the newest id versions every page
+    with get_db() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT max(transaction_id) FROM transactions WHERE user_id = %s;", [session["user_id"]])
+            last_transaction = cursor.fetchone()[0]
+
+    def build():
+        transactions, next_page = _history_page(session["user_id"], filters, limit, before)
+        return {'transactions': [{'id': transaction['transaction_id'],
+                                  'symbol': transaction['symbol'].upper(),
+                                  'action': transaction['action'],
+                                  'shares': transaction['shares'],
+                                  'price': float(transaction['price']),
+                                  'datetime': transaction['datetime'].isoformat()}
+                                 for transaction in transactions],
+                'next': next_page}
+
+    return _api_response(('history', last_transaction, request.query_string), build)
+
+
+@app.route("/api/v1/optimisations/<job_id>")
+@api_login_required
+def api_optimisation(job_id):
+    """Status of an optimisation job, and its result once done"""
+
+    job = job_queue.get(job_id, session["user_id"])
+    if job is None:
+        return {'error': 'Unknown job'}, 404
+
+    def build():
+        return {'id': job['id'],
+                'status': job['status'],
+                'progress': job['progress'],
+                'message': job['message'],
+                'error': job['error'],
+                'params': {key: value for key, value in job['params'].items() if key != 'stocks'},
+                'result': job['result']}
+
+    # a finished job never changes again
+    finished = job['status'] in ('done', 'failed')
+    return _api_response(('optimisation', job['id'], job['status'], job['progress'], job['message']), build,
+                         max_age=365 * 24 * 60 * 60 if finished else 0, immutable=finished)
 
 
 if __name__ == '__main__':
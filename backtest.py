@@ -0,0 +1,39 @@
+from collections import namedtuple
+
+import numpy as np
+
+
+Backtest = namedtuple('Backtest', ['returns', 'portfolio_returns', 'growth'])
+
+
+def returns_from_prices(prices):
+    """
+    Daily simple returns of a (days x assets) price matrix.
+
+    The first day has a return of 0, and days where either close is missing
+    count as 0 as well, so assets listed later simply sit out until they trade.
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    returns = np.zeros_like(prices)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns[1:] = prices[1:] / prices[:-1] - 1
+    returns[~np.isfinite(returns)] = 0
+    return returns
+
+
+def run(prices, weights):
+    """
+    Backtest N fixed-weight portfolios over the same price history at once.
+
+    prices is a (days x assets) matrix of closes and weights an (N x assets)
+    matrix with one row per portfolio, columns in the same asset order.
+    Returns the asset returns (days x assets), the weighted portfolio returns
+    (days x N) and the cumulative growth of 1 unit invested (days x N).
+    """
+    weights = np.atleast_2d(np.asarray(weights, dtype=np.float64))
+
+    returns = returns_from_prices(prices)
+    portfolio_returns = returns @ weights.T
+    growth = np.cumprod(1 + portfolio_returns, axis=0)
+
+    return Backtest(returns, portfolio_returns, growth)
@@ -0,0 +1,86 @@
+"""
+Micro-benchmarks of the numeric hot paths: returns, backtest, projection.
+
+Inputs are synthetic and seeded, so timings only move when the code (or the
+machine) does. Save a baseline and compare later runs against it to catch
+regressions; the exit status is 1 if any case got slower than the tolerance.
+
+    python benchmarks/hot_paths.py [--save baseline.json] [--compare baseline.json] [--tolerance 0.25]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backtest
+import montecarlo
+
+
+def cases():
+    """name -> zero-argument callable"""
+    rng = np.random.default_rng(0)
+
+    # about 20 years of daily closes for a 30-stock portfolio
+    days, assets = 5000, 30
+    prices = 100 * np.exp(np.cumsum(rng.normal(0.0003, 0.02, (days, assets)), axis=0))
+    prices[:250, -5:] = np.nan  # a few late listings
+    weights = rng.dirichlet(np.ones(assets), size=2)
+
+    factors = rng.normal(scale=0.1, size=(assets, assets))
+    S = factors @ factors.T + np.eye(assets) * 0.02
+    mu = rng.uniform(0.02, 0.12, assets)
+
+    return {
+        'returns_from_prices 5000x30': lambda: backtest.returns_from_prices(prices),
+        'backtest.run 5000x30, 2 portfolios': lambda: backtest.run(prices, weights),
+        'montecarlo 10k paths x 1 year': lambda: montecarlo.simulate(mu, S, weights, 1, paths=10000),
+    }
+
+
+def measure(fn, repeat=5):
+    # best of repeat, each averaged over enough calls to take ~0.2 s
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--save', help='write the timings to this JSON file')
+    parser.add_argument('--compare', help='compare against timings saved earlier')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown, 0.25 = 25%%')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    for name, fn in cases().items():
+        results[name] = measure(fn)
+        line = f"{name:<40}{results[name] * 1000:>10.3f} ms"
+        if name in baseline:
+            change = results[name] / baseline[name] - 1
+            line += f"   {change:+7.1%} vs baseline"
+            if change > args.tolerance:
+                regressions.append(name)
+                line += "   REGRESSION"
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Cold-start benchmark: how long a fresh interpreter takes to import app.py.
+
+Each run is a new process, so nothing is warm. It also checks that importing
+the app neither loads the analytics stack nor needs a reachable database,
+and times the first optimisation-side import separately for comparison.
+
+    python benchmarks/import_time.py [--runs 10]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY = ['pandas', 'numpy', 'matplotlib', 'yfinance', 'pypfopt', 'cvxpy']
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+loaded = [name for name in {heavy!r} if name in sys.modules]
+print(elapsed, ','.join(loaded))
+"""
+
+
+def measure(module, runs, env):
+    times = []
+    loaded = ''
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-W', 'ignore', '-c', PROBE.format(module=module, heavy=HEAVY)],
+            cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+        ).stdout.split()
+        times.append(float(output[0]))
+        loaded = output[1] if len(output) > 1 else ''
+    return times, loaded
+
+
+def report(label, times, loaded):
+    print(f"{label:<28} median {statistics.median(times) * 1000:8.1f} ms"
+          f"   min {min(times) * 1000:8.1f} ms   heavy modules loaded: {loaded or 'none'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    # an unreachable database proves startup no longer connects
+    env = dict(os.environ, DATABASE_URL='postgresql://nobody@127.0.0.1:1/none', SECRET_KEY='bench')
+
+    times, loaded = measure('app', args.runs, env)
+    report('import app', times, loaded)
+
+    times, loaded = measure('optimiser', args.runs, env)
+    report('import optimiser (deferred)', times, loaded)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Load test: drive the main routes at controlled concurrency against PostgreSQL.
+
+Market data comes from the deterministic replay provider (MARKET_DATA=replay)
+so no request leaves the machine and runs are comparable. The app is served
+by a threaded local server; every worker is its own user with its own
+session and repeatedly loads /, buys and sells one share, loads /history and,
+every few rounds, runs an optimisation to completion. Reports latency
+percentiles per route and overall throughput for each concurrency level.
+
+    DATABASE_URL=postgresql://localhost/bench python benchmarks/load.py \
+        [--concurrency 1 4 16] [--rounds 20] [--optimise-every 5] [--latency 0.05]
+
+SESSION_BACKEND selects the session backend under test as it does for the app.
+
+Writes users, trades and jobs into that database, so point it at a
+scratch one.
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SYMBOLS = ['AAA', 'BBB', 'CCC', 'DDD']
+
+
+def serve(app):
+    """Start app on a free local port, returns its base URL"""
+    from werkzeug.serving import make_server
+
+    # one log line per request would swamp the report
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+class Worker:
+    """One simulated user with its own session"""
+
+    def __init__(self, base, name, timings):
+        self.base = base
+        self.http = requests.Session()
+        self.timings = timings
+        self.errors = 0
+
+        password = uuid.uuid4().hex
+        self.post('/register', {'username': name, 'password': password, 'confirmation': password}, record=False)
+        self.post('/login', {'username': name, 'password': password}, record=False)
+        self.post('/deposit', {'cash': '1000000'}, record=False)
+        for symbol in SYMBOLS:
+            self.post('/buy', {'symbol': symbol, 'shares': '10'}, record=False)
+
+    def get(self, path, route=None, record=True):
+        return self._request('GET', path, route, record)
+
+    def post(self, path, data, route=None, record=True):
+        return self._request('POST', path, route, record, data=data)
+
+    def _request(self, method, path, route, record, **kwargs):
+        start = time.perf_counter()
+        response = self.http.request(method, self.base + path, allow_redirects=False, **kwargs)
+        elapsed = time.perf_counter() - start
+        if response.status_code >= 400:
+            self.errors += 1
+        if record:
+            self.timings.setdefault(route or f'{method} {path}', []).append(elapsed)
+        return response
+
+    def round(self, number, optimise_every):
+        symbol = SYMBOLS[number % len(SYMBOLS)]
+        self.get('/')
+        self.post('/buy', {'symbol': symbol, 'shares': '1'})
+        self.post('/sell', {'symbol': symbol, 'shares': '1'})
+        self.get('/history')
+
+        if optimise_every and number % optimise_every == 0:
+            # a different year each time so the job is not served from a previous run
+            start = time.perf_counter()
+            response = self.post('/optimise', {'year': str(2005 + number % 15)})
+            job_id = response.headers.get('Location', '').rsplit('/', 1)[-1]
+            while job_id:
+                status = self.get(f'/optimise/status/{job_id}', route='GET /optimise/status').json()
+                if status['status'] in ('done', 'failed'):
+                    break
+                time.sleep(0.05)
+            self.timings.setdefault('optimise (queued to done)', []).append(time.perf_counter() - start)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run(base, concurrency, rounds, optimise_every):
+    run_id = uuid.uuid4().hex[:8]
+    timings = {}
+    workers = [Worker(base, f'bench-{run_id}-{i}', timings) for i in range(concurrency)]
+
+    def drive(worker):
+        for number in range(rounds):
+            worker.round(number, optimise_every)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(drive, workers))
+    elapsed = time.perf_counter() - start
+
+    total = sum(len(values) for route, values in timings.items() if not route.startswith('optimise ('))
+    print(f"\nconcurrency {concurrency}: {total} requests in {elapsed:.2f} s, "
+          f"{total / elapsed:.1f} req/s, {sum(worker.errors for worker in workers)} errors")
+    print(f"{'route':<28}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for route, values in sorted(timings.items()):
+        print(f"{route:<28}{len(values):>7}"
+              f"{statistics.median(values) * 1000:>10.1f}"
+              f"{percentile(values, 0.9) * 1000:>10.1f}"
+              f"{percentile(values, 0.99) * 1000:>10.1f}"
+              f"{max(values) * 1000:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--optimise-every', type=int, default=5, help='0 to skip optimisations')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per market data call')
+    args = parser.parse_args()
+
+    if not os.getenv('DATABASE_URL'):
+        parser.error('DATABASE_URL must point at a scratch PostgreSQL database')
+
+    # offline market data, and a scratch directory for sessions, history and charts
+    scratch = tempfile.mkdtemp(prefix='bench-')
+    os.environ['MARKET_DATA'] = 'replay'
+    os.environ.setdefault('SECRET_KEY', uuid.uuid4().hex)
+    os.environ['MARKET_DATA_LATENCY'] = str(args.latency)
+    for name in ('HISTORY_DIR', 'CHART_DIR', 'UNIVERSE_DIR'):
+        os.environ[name] = os.path.join(scratch, name.lower())
+    os.chdir(scratch)
+
+    import db
+    import migrations
+    from app import app
+
+    with db.pool.connection() as connection:
+        migrations.migrate(connection)
+
+    base = serve(app)
+    for concurrency in args.concurrency:
+        run(base, concurrency, args.rounds, args.optimise_every)
+
+
+if __name__ == '__main__':
+    main()
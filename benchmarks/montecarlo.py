@@ -0,0 +1,47 @@
+"""
+Monte Carlo projection benchmark: wall time and peak memory of a projection.
+
+Uses a synthetic covariance, so it needs neither the database nor market
+data. Peak memory should stay flat as the horizon grows and scale with
+paths x checkpoints, not paths x days.
+
+    python benchmarks/montecarlo.py [--paths 100000] [--years 1 5 10] [--assets 20]
+"""
+import argparse
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import montecarlo
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--paths', type=int, default=100000)
+    parser.add_argument('--years', type=int, nargs='+', default=[1, 5, 10])
+    parser.add_argument('--assets', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    factors = rng.normal(scale=0.1, size=(args.assets, args.assets))
+    S = factors @ factors.T + np.eye(args.assets) * 0.02
+    mu = rng.uniform(0.02, 0.12, args.assets)
+    weights = rng.dirichlet(np.ones(args.assets), size=2)
+
+    for years in args.years:
+        start = time.perf_counter()
+        result = montecarlo.simulate(mu, S, weights, years, paths=args.paths)
+        elapsed = time.perf_counter() - start
+        # ru_maxrss is in kilobytes on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"{args.paths} paths x {years:>2} years: {elapsed:7.2f} s"
+              f"   peak rss {peak:7.1f} MB   P(loss) {result.prob_loss.round(3).tolist()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Per-request session overhead of each SESSION_BACKEND.
+
+A bare Flask app is installed with each backend in turn and driven by the
+test client, so nothing but the session differs. A logged-in user loads a
+page that reads user_id (the common case) and one that also changes the
+session (a write, like setting a flash message). Each result is shown next
+to a baseline whose session is never loaded or saved. The database backend
+is measured only when DATABASE_URL points at PostgreSQL, and it writes to
+that database's sessions table.
+
+    python benchmarks/sessions.py [--requests 2000]
+    DATABASE_URL=postgresql://localhost/bench python benchmarks/sessions.py
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from flask import Flask, session
+from flask.sessions import SecureCookieSession, SessionInterface
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import migrations
+import sessions
+
+
+class NoSession(SessionInterface):
+    """Baseline: an empty in-memory session that is never loaded or saved"""
+
+    def open_session(self, app, request):
+        return SecureCookieSession({'user_id': 1})
+
+    def save_session(self, app, session, response):
+        pass
+
+
+def make_app(backend, scratch):
+    app = Flask('bench')
+    app.config['SECRET_KEY'] = 'bench'
+    app.config['SESSION_PERMANENT'] = False
+    app.config['SESSION_FILE_DIR'] = os.path.join(scratch, 'flask_session')
+
+    if backend == 'none':
+        app.session_interface = NoSession()
+    else:
+        sessions.init_app(app, backend)
+
+    @app.route('/login')
+    def login():
+        session.clear()
+        session['user_id'] = 1
+        return ''
+
+    @app.route('/read')
+    def read():
+        return str(session.get('user_id'))
+
+    @app.route('/write')
+    def write():
+        session['visits'] = session.get('visits', 0) + 1
+        return str(session.get('user_id'))
+
+    return app
+
+
+def measure(app, path, requests):
+    client = app.test_client()
+    client.get('/login')
+    for _ in range(50):
+        client.get(path)
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.get(path)
+    return (time.perf_counter() - start) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    backends = ['none', 'filesystem', 'cookie']
+    if os.getenv('DATABASE_URL'):
+        backends.append('database')
+        db.init_app(Flask('migrate'))
+        with db.pool.connection() as connection:
+            migrations.migrate(connection)
+
+    scratch = tempfile.mkdtemp(prefix='bench-')
+    results = {}
+    print(f"{'backend':<12}{'read us':>10}{'overhead':>10}{'write us':>10}{'overhead':>10}")
+    for backend in backends:
+        app = make_app(backend, scratch)
+        read = measure(app, '/read', args.requests)
+        write = measure(app, '/write', args.requests)
+        results[backend] = read, write
+        base_read, base_write = results['none']
+        print(f"{backend:<12}{read * 1e6:>10.1f}{(read - base_read) * 1e6:>10.1f}"
+              f"{write * 1e6:>10.1f}{(write - base_write) * 1e6:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from cache import TTLCache
+
+
+class ChartStore:
+    """
+    Content-addressed line charts.
+
+    A chart is saved as its data series (dates plus one or more labelled
+    lines and optional shaded bands) under the sha256 of that data, so the key doubles as a strong
+    ETag. PNGs are rendered ahead of time on a small background pool (or by
+    the first request that needs one), written next to the series and kept
+    in an in-memory cache; the series itself can be served as JSON for the
+    browser to draw.
+
+    Charts not saved again for `max_age` seconds are deleted from disk by
+    `sweep`, which runs behind a save at most every `sweep_interval` seconds
+    (and from `flask sweep-charts`), so the directory does not grow without
+    bound.
+    """
+
+    def __init__(self, directory, max_workers=2, max_age=30 * 24 * 60 * 60, sweep_interval=60 * 60):
+        self.directory = directory
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self._last_sweep = time.monotonic()
+        self._lock = threading.Lock()
+        self.images = TTLCache(maxsize=int(os.getenv("CHART_CACHE_SIZE", 128)),
+                               ttl=float(os.getenv("CHART_CACHE_TTL", 60 * 60)))
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='charts')
+
+    def save(self, series):
+        """Store series and start rendering it, returns the chart key"""
+        payload = json.dumps(series, sort_keys=True, separators=(',', ':')).encode('utf8')
+        key = hashlib.sha256(payload).hexdigest()
+
+        path = self._path(key, '.json')
+        if os.path.exists(path):
+            # still in use, keep it from being swept
+            os.utime(path)
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(payload)
+            os.replace(path + '.tmp', path)
+
+        # render ahead of the first request for the image
+        self._executor.submit(self.png, key)
+        if self._sweep_due():
+            self._executor.submit(self.sweep)
+        return key
+
+    def series(self, key):
+        """Raw JSON of the series, None for an unknown key"""
+        try:
+            with open(self._path(key, '.json'), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def modified(self, key):
+        """When the chart was last saved"""
+        return os.path.getmtime(self._path(key, '.json'))
+
+    def png(self, key):
+        """Rendered PNG bytes, None for an unknown key"""
+        # concurrent requests for the same chart wait on a single render; it
+        # runs in the calling thread, as pre-renders already run on the pool
+        return self.images.get_or_load(key, lambda: self._render(key))
+
+    def _render(self, key):
+        path = self._path(key, '.png')
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return f.read()
+
+        payload = self.series(key)
+        if payload is None:
+            return None
+
+        from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+
+        fig = create_figure(json.loads(payload))
+        image = BytesIO()
+        FigureCanvas(fig).print_png(image)
+
+        with open(path + '.tmp', 'wb') as f:
+            f.write(image.getvalue())
+        os.replace(path + '.tmp', path)
+        return image.getvalue()
+
+    def sweep(self, max_age=None):
+        """Delete charts not saved again within max_age seconds, returns how many"""
+        cutoff = time.time() - (self.max_age if max_age is None else max_age)
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+
+        count = 0
+        for name in names:
+            key, _, suffix = name.partition('.')
+            if not is_key(key) or suffix != 'json':
+                continue
+            try:
+                if os.path.getmtime(self._path(key, '.json')) >= cutoff:
+                    continue
+                # the image first: a series without one is simply rendered again
+                for path in (self._path(key, '.png'), self._path(key, '.json')):
+                    if os.path.exists(path):
+                        os.remove(path)
+            except OSError:
+                continue
+            self.images.delete(key)
+            count += 1
+        return count
+
+    def _sweep_due(self):
+        with self._lock:
+            if time.monotonic() - self._last_sweep < self.sweep_interval:
+                return False
+            self._last_sweep = time.monotonic()
+            return True
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+
+def is_key(value):
+    """Whether value looks like a chart key (and is safe to use in a path)"""
+    return re.fullmatch(r'[0-9a-f]{64}', value) is not None
+
+
+_style_lock = threading.Lock()
+
+
+def create_figure(series):
+    # a standalone Figure (not pyplot) is safe to build in worker threads
+    # and is freed with the last reference instead of piling up in pyplot
+    import numpy as np
+    import matplotlib.style
+    from matplotlib.figure import Figure
+
+    dates = np.array(series['dates'], dtype='datetime64[D]')
+
+    # the style only applies while the figure is built, not process-wide;
+    # rcParams are global, so figures are built one at a time (the slow
+    # rendering to PNG happens outside the lock)
+    with _style_lock, matplotlib.style.context('ggplot'):
+        fig = Figure()
+        ax = fig.subplots()
+        for line in series['lines']:
+            ax.plot(dates, line['values'], label = line['label'])
+        # shaded ranges, e.g. the percentile fan of a projection
+        for band in series.get('bands', []):
+            ax.fill_between(dates, band['lower'], band['upper'], alpha = 0.2, label = band['label'])
+        ax.set_xlabel(series.get('xlabel', 'Date'))
+        ax.set_ylabel(series.get('ylabel', ''))
+        ax.set_title(series.get('title', ''))
+        ax.legend()
+    return fig
+
+
+# process-wide chart store
+store = ChartStore(os.getenv("CHART_DIR", "data/charts"),
+                   max_age=float(os.getenv("CHART_MAX_AGE", 30 * 24 * 60 * 60)),
+                   sweep_interval=float(os.getenv("CHART_SWEEP_INTERVAL", 60 * 60)))
@@ -0,0 +1,170 @@
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+from flask import g, has_request_context
+
+import metrics
+
+
+class Pool:
+    """
+    Thread-safe pool of PostgreSQL connections.
+
+    Holds between `minconn` and `maxconn` connections, opened on first use
+    rather than at import. Checkout blocks for up to `timeout` seconds when
+    all of them are in use. Connections are checked on checkout (closed ones
+    are replaced, ones idle for longer than `ping_after` seconds are pinged
+    first), so a dropped server connection costs a reconnect instead of
+    taking the app down.
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=30, ping_after=30):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._filled = False
+
+    def _fill(self):
+        # open the first minconn connections on first checkout, not at import
+        with self._lock:
+            if self._filled:
+                return
+            self._filled = True
+        for _ in range(self.minconn - 1):
+            connection = self._connect()
+            with self._lock:
+                self._idle.append((connection, time.monotonic()))
+
+    def _connect(self):
+        # cursors of an instrumented connection time every statement
+        return psycopg2.connect(self.dsn, connection_factory=metrics.InstrumentedConnection)
+
+    def _healthy(self, connection, idle_since):
+        if connection.closed:
+            return False
+        if time.monotonic() - idle_since < self.ping_after:
+            return True
+        try:
+            with connection:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1;")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """Check a connection out of the pool"""
+        if not self._filled:
+            self._fill()
+
+        if not self._slots.acquire(timeout=self.timeout):
+            raise psycopg2.pool.PoolError("connection pool exhausted")
+
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    connection, idle_since = self._idle.pop()
+                if self._healthy(connection, idle_since):
+                    return connection
+                self._discard(connection)
+            return self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, connection):
+        """Return a connection to the pool"""
+        try:
+            if connection.closed:
+                return
+            status = connection.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                self._discard(connection)
+                return
+
+            # never hand out a connection in the middle of a transaction
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+
+            with self._lock:
+                self._idle.append((connection, time.monotonic()))
+        except psycopg2.Error:
+            self._discard(connection)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of a with block"""
+        connection = self.getconn()
+        try:
+            yield connection
+        finally:
+            self.putconn(connection)
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._discard(connection)
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+
+# process-wide pool, created by init_app
+pool = None
+
+
+def init_app(app):
+    """Create the connection pool and return per-request connections to it"""
+    global pool
+    pool = Pool(
+        os.getenv("DATABASE_URL"),
+        minconn=int(os.getenv("DB_POOL_MIN", 1)),
+        maxconn=int(os.getenv("DB_POOL_MAX", 10)),
+    )
+    app.teardown_appcontext(close_db)
+
+
+def get_db():
+    """Connection checked out for the current request"""
+    if 'db' not in g:
+        g.db = pool.getconn()
+    return g.db
+
+
+@contextmanager
+def connection():
+    """
+    A connection for the duration of a with block that never makes a request
+    hold two pooled connections: inside a request it is the request's own
+    (see get_db), elsewhere (job workers, CLI commands) one from the pool.
+    """
+    if has_request_context():
+        yield get_db()
+    else:
+        with pool.connection() as pooled:
+            yield pooled
+
+
+def close_db(exception=None):
+    connection = g.pop('db', None)
+    if connection is not None:
+        pool.putconn(connection)
@@ -0,0 +1,59 @@
+import warnings
+
+import cvxpy as cp
+import numpy as np
+
+
+def portfolio_point(weights, mu, S):
+    """(volatility, expected return) of a weight vector"""
+    weights = np.asarray(weights, dtype=np.float64)
+    return float(np.sqrt(weights @ S @ weights)), float(weights @ mu)
+
+
+def sweep(mu, S, points=50):
+    """
+    Long-only efficient frontier: the minimum-volatility portfolio for a grid
+    of target returns between the global minimum-variance portfolio and the
+    best single asset.
+
+    The problem is built once with the target return as a cvxpy Parameter,
+    so every point after the first reuses the compiled problem and starts
+    the solver from the previous solution. Returns a list of dicts with the
+    volatility, return and weights of each point, lowest return first.
+    """
+    mu = np.asarray(mu, dtype=np.float64)
+    S = np.asarray(S, dtype=np.float64)
+    n = len(mu)
+
+    weights = cp.Variable(n)
+    target = cp.Parameter()
+    variance = cp.quad_form(weights, cp.psd_wrap(S))
+    problem = cp.Problem(cp.Minimize(variance),
+                         [cp.sum(weights) == 1, weights >= 0, mu @ weights >= target])
+
+    # the lowest target anything can miss is the smallest asset return,
+    # which leaves the global minimum-variance portfolio unconstrained
+    target.value = mu.min()
+    problem.solve(solver=cp.OSQP, warm_start=True)
+    lowest = float(mu @ weights.value)
+
+    curve = []
+    for value in np.linspace(lowest, mu.max(), points):
+        target.value = value
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            problem.solve(solver=cp.OSQP, warm_start=True)
+
+        # close to the single-asset end OSQP can stall; an interior-point
+        # solve of the same compiled problem takes over for those points
+        if problem.status != cp.OPTIMAL:
+            problem.solve(solver=cp.ECOS)
+        if problem.status not in (cp.OPTIMAL, cp.OPTIMAL_INACCURATE):
+            continue
+        solution = np.clip(weights.value, 0, None)
+        solution /= solution.sum()
+        volatility, expected = portfolio_point(solution, mu, S)
+        curve.append({'volatility': volatility,
+                      'return': expected,
+                      'weights': solution.round(4).tolist()})
+    return curve
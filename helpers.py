@@ -1,15 +1,28 @@
 import csv
 import datetime
+import os
 import pytz
 import requests
 import subprocess
 import urllib
 import uuid
-import yfinance as yf
 
+from concurrent.futures import ThreadPoolExecutor
 from flask import redirect, render_template, session
 from functools import wraps
 
+import marketdata
+import metrics
+from cache import TTLCache
+from symbols import store as symbol_store
+
+
+# process-wide quote cache shared by every request
+quote_cache = TTLCache(
+    maxsize=int(os.getenv("QUOTE_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("QUOTE_CACHE_TTL", 60)),
+)
+
 
 def login_required(f):
     """
@@ -24,6 +37,16 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+
+def api_login_required(f):
+    """Like login_required, but answers 401 with a JSON error instead of redirecting"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if session.get("user_id") is None:
+            return {"error": "Login required"}, 401
+        return f(*args, **kwargs)
+    return decorated_function
+
 """
 def lookup(symbol):
     #Look up quote for symbol
@@ -59,25 +82,115 @@ def lookup(symbol):
     except (requests.RequestException, ValueError, KeyError, IndexError):
         return None
 """
+@metrics.timed(metrics.quote_lookup_seconds, call='lookup')
 def lookup(symbol):
-    # Look up quote for symbol
+    """Look up quote for symbol, served from the quote cache while fresh"""
     symbol = symbol.upper()
 
-    try:
-        ticker = yf.Ticker(symbol)
-        price = ticker.history(period='1d')['Close'][0]
-        #data = yf.download(list_of_tickers, year)['Adj Close']
-        price = round(float(price), 2)
-        name = ticker.info['shortName'] #shortName
+    # concurrent lookups of the same symbol share one upstream fetch
+    stock = quote_cache.get_or_load(symbol, lambda: _fetch_quote(symbol))
 
-        return {
-            "name": ticker,
+    # hand out a copy so callers can reformat it without touching the cache
+    if stock is None:
+        return None
+    return dict(stock)
+
+
+@metrics.timed(metrics.quote_lookup_seconds, call='lookup_many')
+def lookup_many(symbols):
+    """
+    Look up quotes for several symbols at once.
+
+    Prices come from one bulk download and names are fetched in parallel.
+    Returns a dict mapping each upper-cased symbol to its quote, or to None
+    if that symbol could not be looked up.
+    """
+    symbols = list(dict.fromkeys(symbol.upper() for symbol in symbols))
+
+    # serve whatever is still fresh in the quote cache
+    quotes = {}
+    missing = []
+    for symbol in symbols:
+        stock = quote_cache.get(symbol)
+        if stock is None:
+            missing.append(symbol)
+        else:
+            quotes[symbol] = dict(stock)
+
+    if not missing:
+        return quotes
+
+    # one bulk price download running alongside the name lookups
+    with ThreadPoolExecutor(max_workers=min(8, len(missing)) + 1) as executor:
+        prices = executor.submit(_fetch_prices, missing)
+        names = dict(zip(missing, executor.map(_fetch_name, missing)))
+        prices = prices.result()
+
+    for symbol in missing:
+        price = prices.get(symbol)
+        name = names.get(symbol)
+        if price is None or name is None:
+            quotes[symbol] = None
+            continue
+        stock = {
+            "name": name,
             "price": price,
-            "name": name
+            "symbol": symbol
         }
-    except (requests.RequestException, ValueError, KeyError, IndexError):
+        quote_cache.set(symbol, stock)
+        quotes[symbol] = dict(stock)
+
+    return quotes
+
+
+def refresh_prices(symbols):
+    """
+    Fetch the latest price of symbols in one download, bypassing the cache.
+
+    Fresh prices are written through to the quote cache for symbols whose
+    name is known, so page loads pick them up too. Returns a dict mapping
+    each upper-cased symbol that could be priced to its price.
+    """
+    symbols = list(dict.fromkeys(symbol.upper() for symbol in symbols))
+    if not symbols:
+        return {}
+
+    prices = _fetch_prices(symbols)
+    for symbol, price in prices.items():
+        stock = quote_cache.get(symbol)
+        name = stock["name"] if stock is not None else symbol_store.name(symbol)
+        if name is not None:
+            quote_cache.set(symbol, {"name": name, "price": price, "symbol": symbol})
+    return prices
+
+
+def _fetch_quote(symbol):
+    # Look up quote for symbol with the market data provider
+    price = marketdata.provider.quote(symbol)
+    if price is None:
+        return None
+
+    # name comes from the symbol store, not ticker.info
+    name = symbol_store.name(symbol)
+    if name is None:
         return None
 
+    return {
+        "name": name,
+        "price": price,
+        "symbol": symbol
+    }
+
+
+def _fetch_prices(symbols):
+    # latest close of every symbol in a single download
+    return marketdata.provider.prices(symbols)
+
+
+def _fetch_name(symbol):
+    # company name of symbol, None if yahoo does not know it
+    return symbol_store.name(symbol)
+
 
 def usd(value):
     """Format value as USD."""
@@ -0,0 +1,169 @@
+import json
+import os
+import threading
+
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+import marketdata
+
+
+class HistoryStore:
+    """
+    Local store of daily adjusted closes, one pair of .npy files per symbol.
+
+    Files are memory-mapped on read. A sync only downloads the bars after the
+    last stored date (at most once per day), so repeat requests for the same
+    tickers are served from disk without touching the network. The lock only
+    guards writing the files.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def window(self, symbols, start):
+        """
+        Adjusted closes of symbols from start until the last completed session.
+
+        Same shape as yf.download(symbols, start)['Adj Close']: a frame with
+        the dates as index and one column per ticker.
+        """
+        symbols = [symbol.upper() for symbol in symbols]
+        start = _day(start)
+        self.sync(symbols, start)
+
+        columns = {}
+        for symbol in symbols:
+            # a symbol the provider has no data for yet comes back empty
+            dates, closes, _ = self._load(symbol) or (*_EMPTY, None)
+            first = np.searchsorted(dates, start)
+            columns[symbol] = pd.Series(np.array(closes[first:]),
+                                        index=pd.DatetimeIndex(dates[first:]))
+
+        data = pd.concat(columns, axis=1).sort_index()
+        data.index.name = 'Date'
+        return data
+
+    def sync(self, symbols, start):
+        """
+        Make sure every symbol is stored from start up to the last completed
+        session.
+
+        Today's bar is still moving while the market is open, so only bars
+        before today are stored; the day's close is picked up tomorrow.
+        Downloads run outside the lock, so syncs of different tickers overlap.
+        Only symbols the provider returned data for are stamped as synced;
+        the rest (e.g. after a network error, which yfinance reports as empty
+        data) are tried again on the next call.
+        """
+        start = _day(start)
+        today = np.datetime64(date.today(), 'D')
+
+        full = []
+        tail = {}
+        for symbol in symbols:
+            stored = self._load(symbol)
+            if stored is None or start < stored[2]['since']:
+                full.append(symbol)
+            elif stored[2]['synced'] < today:
+                tail[symbol] = stored
+
+        # only download the bars after the last stored date
+        if tail:
+            since = min(stored[0][-1] if len(stored[0]) else stored[2]['since']
+                        for stored in tail.values())
+            fresh = _completed(_download(list(tail), since), today)
+            with self._lock:
+                for symbol, (dates, closes, meta) in tail.items():
+                    if symbol not in fresh or self._synced(symbol, meta['since'], today):
+                        continue
+                    new_dates, new_closes = fresh[symbol]
+                    if len(dates):
+                        # adjusted closes are rebased after dividends and splits;
+                        # if the overlapping bar moved, refetch the whole series
+                        overlap = new_dates == dates[-1]
+                        if overlap.any() and not np.isclose(new_closes[overlap][0], closes[-1]):
+                            full.append(symbol)
+                            continue
+                        newer = new_dates > dates[-1]
+                        new_dates = np.concatenate([dates, new_dates[newer]])
+                        new_closes = np.concatenate([closes, new_closes[newer]])
+                    self._save(symbol, new_dates, new_closes, meta['since'], today)
+
+        if full:
+            since = start
+            for symbol in full:
+                stored = self._load(symbol)
+                if stored is not None:
+                    since = min(since, stored[2]['since'])
+            fresh = _completed(_download(full, since), today)
+            with self._lock:
+                for symbol in full:
+                    if symbol in fresh and not self._synced(symbol, since, today):
+                        self._save(symbol, *fresh[symbol], since, today)
+
+    def _synced(self, symbol, since, today):
+        # whether another sync already stored symbol from since up to today
+        stored = self._load(symbol)
+        return stored is not None and stored[2]['since'] <= since and stored[2]['synced'] >= today
+
+    def _paths(self, symbol):
+        base = os.path.join(self.directory, symbol)
+        return base + '.dates.npy', base + '.close.npy', base + '.json'
+
+    def _load(self, symbol):
+        # (dates, closes, meta) or None if the symbol was never stored
+        dates_path, closes_path, meta_path = self._paths(symbol)
+        if not os.path.exists(meta_path):
+            return None
+
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta = {key: np.datetime64(value, 'D') for key, value in meta.items()}
+
+        dates = np.load(dates_path, mmap_mode='r')
+        closes = np.load(closes_path, mmap_mode='r')
+        return dates, closes, meta
+
+    def _save(self, symbol, dates, closes, since, synced):
+        os.makedirs(self.directory, exist_ok=True)
+
+        # write next to the target and swap in, so readers never see half a file
+        for path, values in zip(self._paths(symbol), (dates, closes)):
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, values)
+            os.replace(path + '.tmp', path)
+
+        meta_path = self._paths(symbol)[2]
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({'since': str(since), 'synced': str(synced)}, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+
+_EMPTY = (np.array([], dtype='datetime64[D]'), np.array([], dtype=np.float64))
+
+
+def _day(value):
+    # anything pandas understands as a date, e.g. '2018-1-1'
+    return np.datetime64(pd.Timestamp(value).date(), 'D')
+
+
+def _completed(fresh, today):
+    # drop today's (unfinished) bar from {symbol: (dates, closes)}
+    completed = {}
+    for symbol, (dates, closes) in fresh.items():
+        keep = dates < today
+        completed[symbol] = (dates[keep], closes[keep])
+    return completed
+
+
+def _download(symbols, start):
+    # {symbol: (dates, closes)} for every symbol the provider returned data for
+    return marketdata.provider.history(symbols, start)
+
+
+# process-wide store
+store = HistoryStore(os.getenv("HISTORY_DIR", "data/history"))
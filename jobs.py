@@ -0,0 +1,190 @@
+import os
+import socket
+import threading
+import traceback
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta
+
+import psycopg2
+import psycopg2.extras
+
+import db
+import profiler
+
+
+class JobError(Exception):
+    """A job failure whose message can be shown to the user"""
+
+
+class JobQueue:
+    """
+    Background jobs run on a local worker pool, tracked in the jobs table.
+
+    Status, progress and the result are persisted, so any request (or a
+    page reload) can read them back without recomputing. Submitting the same
+    work again returns the existing job instead of queueing a duplicate, as
+    long as it is still running or finished today; a new day means new
+    prices, so older results are recomputed.
+
+    Jobs only live in the process that queued them. Each process stamps a
+    heartbeat on its unfinished jobs every `heartbeat_interval` seconds;
+    unfinished jobs of other processes whose heartbeat is older than
+    `dead_after` (e.g. after a restart) are marked failed, so pages polling
+    them stop and resubmitting starts a new job.
+    """
+
+    heartbeat_interval = 30
+    dead_after = timedelta(seconds=3 * heartbeat_interval)
+
+    def __init__(self, max_workers=2):
+        self.pool = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='jobs')
+        self._token = uuid.uuid4().hex[:8]
+        self._pending = 0
+        self._beating = None
+        self._recovered = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, pool):
+        # connections come from db.connection, so a request polling a job
+        # shares its own connection instead of taking a second one
+        self.pool = pool
+
+    def submit(self, user_id, kind, params, fn, profile=False):
+        """
+        Queue fn(params, progress) for user and return the job id.
+
+        fn must return a JSON-serialisable result. With profile set, the run
+        is sampled and its profile written like a profiled request's.
+        """
+        self._recover_if_due()
+
+        with db.connection() as connection:
+            with connection:
+                with connection.cursor() as cursor:
+                    # reuse a job with the same input finished today (or still alive)
+                    cursor.execute(
+                        """SELECT id FROM jobs
+                           WHERE user_id = %s AND kind = %s AND params = %s
+                             AND ((status = 'done' AND created_at >= %s)
+                                  OR (status IN ('queued', 'running') AND heartbeat_at > %s))
+                           ORDER BY created_at DESC LIMIT 1;""",
+                        [user_id, kind, psycopg2.extras.Json(params),
+                         datetime.combine(date.today(), time.min), datetime.now() - self.dead_after]
+                    )
+                    row = cursor.fetchone()
+                    if row is not None:
+                        return row[0]
+
+                    job_id = uuid.uuid4().hex
+                    now = datetime.now()
+                    cursor.execute(
+                        """INSERT INTO jobs (id, user_id, kind, status, progress, params, created_at,
+                                             owner, heartbeat_at)
+                           VALUES (%s, %s, %s, 'queued', 0, %s, %s, %s, %s);""",
+                        [job_id, user_id, kind, psycopg2.extras.Json(params), now, self.owner, now]
+                    )
+
+        with self._lock:
+            self._pending += 1
+            # threads do not survive a fork, so each worker process starts its own
+            if self._beating != os.getpid():
+                self._beating = os.getpid()
+                threading.Thread(target=self._heartbeat, name='jobs-heartbeat', daemon=True).start()
+
+        self._executor.submit(self._run, job_id, params, fn, f'job {kind}' if profile else None)
+        return job_id
+
+    def get(self, job_id, user_id):
+        """The job row, None if it does not exist or belongs to someone else"""
+        self._recover_if_due()
+
+        with db.connection() as connection:
+            with connection:
+                with connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                    cursor.execute(
+                        "SELECT * FROM jobs WHERE id = %s AND user_id = %s;",
+                        [job_id, user_id]
+                    )
+                    return cursor.fetchone()
+
+    def _run(self, job_id, params, fn, profile=None):
+        def progress(fraction, message):
+            self._update(job_id, progress=fraction, message=message)
+
+        try:
+            self._update(job_id, status='running')
+            if profile is None:
+                result = fn(params, progress)
+            else:
+                with profiler.sampling(profile):
+                    result = fn(params, progress)
+        except JobError as error:
+            self._update(job_id, status='failed', error=str(error), finished_at=datetime.now())
+        except Exception:
+            traceback.print_exc()
+            self._update(job_id, status='failed', error='The optimisation failed, please try again',
+                         finished_at=datetime.now())
+        else:
+            self._update(job_id, status='done', progress=1, message='Done',
+                         result=psycopg2.extras.Json(result), finished_at=datetime.now())
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    @property
+    def owner(self):
+        # the pid tells apart workers forked from one preloaded app
+        return f'{socket.gethostname()}:{os.getpid()}:{self._token}'
+
+    def _heartbeat(self):
+        while not threading.Event().wait(self.heartbeat_interval):
+            if not self._pending:
+                continue
+            try:
+                with db.pool.connection() as connection:
+                    with connection:
+                        with connection.cursor() as cursor:
+                            cursor.execute(
+                                """UPDATE jobs SET heartbeat_at = %s
+                                   WHERE owner = %s AND status IN ('queued', 'running');""",
+                                [datetime.now(), self.owner]
+                            )
+            except psycopg2.Error:
+                traceback.print_exc()
+
+    def _recover_if_due(self):
+        # first use in this process, then at most once per heartbeat
+        with self._lock:
+            now = datetime.now().timestamp()
+            if now - self._recovered < self.heartbeat_interval:
+                return
+            self._recovered = now
+
+        with db.connection() as connection:
+            with connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        """UPDATE jobs SET status = 'failed', finished_at = %s,
+                                  error = 'The optimisation was interrupted, please try again'
+                           WHERE status IN ('queued', 'running') AND owner IS DISTINCT FROM %s
+                             AND (heartbeat_at IS NULL OR heartbeat_at < %s);""",
+                        [datetime.now(), self.owner, datetime.now() - self.dead_after]
+                    )
+
+    def _update(self, job_id, **fields):
+        assignments = ", ".join(f"{field} = %s" for field in fields)
+        with db.connection() as connection:
+            with connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f"UPDATE jobs SET {assignments} WHERE id = %s;",
+                        [*fields.values(), job_id]
+                    )
+
+
+# process-wide queue, bound to the database by app.py
+queue = JobQueue(max_workers=int(os.getenv("JOB_WORKERS", 2)))
@@ -0,0 +1,248 @@
+import json
+import math
+import os
+import re
+import threading
+import zlib
+
+from datetime import date
+
+import requests
+
+import metrics
+
+
+# Every call to the outside world for market data goes through `provider`:
+# helpers (quotes), symbols (names) and history_store (daily closes). Set
+# MARKET_DATA=replay to run without network access, e.g. for benchmarks.
+# Heavy imports stay inside the methods so importing this module is cheap.
+
+
+class YahooProvider:
+    """Live market data from Yahoo Finance through yfinance"""
+
+    @metrics.timed(metrics.market_data_seconds, provider='yahoo', call='quote')
+    def quote(self, symbol):
+        """Latest close of symbol, None if yahoo has no price"""
+        import yfinance as yf
+
+        try:
+            price = yf.Ticker(symbol).history(period='1d')['Close'][0]
+            return round(float(price), 2)
+        except (requests.RequestException, ValueError, KeyError, IndexError):
+            return None
+
+    @metrics.timed(metrics.market_data_seconds, provider='yahoo', call='prices')
+    def prices(self, symbols):
+        """Latest close of every symbol in a single download, {symbol: price}"""
+        import yfinance as yf
+
+        try:
+            data = yf.download(symbols, period='1d', progress=False)['Close']
+        except (requests.RequestException, ValueError, KeyError, IndexError):
+            return {}
+
+        # a single ticker comes back as a series instead of a frame
+        if len(symbols) == 1 and not hasattr(data, 'columns'):
+            data = data.to_frame(symbols[0])
+
+        if data.empty:
+            return {}
+
+        latest = data.ffill().iloc[-1]
+        prices = {}
+        for symbol in symbols:
+            price = latest.get(symbol)
+            if price is None or math.isnan(price):
+                continue
+            prices[symbol] = round(float(price), 2)
+        return prices
+
+    @metrics.timed(metrics.market_data_seconds, provider='yahoo', call='history')
+    def history(self, symbols, start):
+        """Daily adjusted closes since start, {symbol: (dates, closes)} for every symbol found"""
+        import numpy as np
+        import yfinance as yf
+
+        data = yf.download(symbols, start=str(start), progress=False)['Adj Close']
+
+        # a single ticker comes back as a series instead of a frame
+        if not hasattr(data, 'columns'):
+            data = data.to_frame(symbols[0])
+
+        if data.index.tz is not None:
+            data.index = data.index.tz_localize(None)
+
+        result = {}
+        for symbol in symbols:
+            if symbol not in data:
+                continue
+            column = data[symbol].dropna()
+            result[symbol] = (column.index.values.astype('datetime64[D]'),
+                              column.values.astype(np.float64))
+        return result
+
+    @metrics.timed(metrics.market_data_seconds, provider='yahoo', call='info')
+    def info(self, symbol):
+        """Name, exchange and currency of symbol, None if yahoo does not know it"""
+        import yfinance as yf
+
+        try:
+            info = yf.Ticker(symbol).info
+            return {'short_name': info['shortName'],
+                    'exchange': info.get('exchange'),
+                    'currency': info.get('currency')}
+        except (requests.RequestException, ValueError, KeyError, IndexError):
+            return None
+
+
+class ReplayProvider:
+    """
+    Deterministic offline market data.
+
+    Symbols with a fixture in `directory` (<SYMBOL>.csv with Date and
+    Adj Close columns, names in symbols.json, as written by `record`) replay
+    it. Any other symbol of one to five letters gets a synthetic daily
+    series: a random walk seeded by the symbol, so every run and every
+    process sees the same prices. Other symbols are unknown, which keeps the
+    invalid-symbol paths reachable. Each call can sleep `latency` seconds to
+    stand in for the network.
+    """
+
+    # first synthetic trading day
+    epoch = '2000-01-03'
+
+    def __init__(self, directory=None, latency=0.0):
+        self.directory = directory
+        self.latency = latency
+        self._series = {}
+        self._lock = threading.Lock()
+
+        self._names = {}
+        if directory and os.path.exists(os.path.join(directory, 'symbols.json')):
+            with open(os.path.join(directory, 'symbols.json')) as f:
+                self._names = json.load(f)
+
+    @metrics.timed(metrics.market_data_seconds, provider='replay', call='quote')
+    def quote(self, symbol):
+        self._wait()
+        series = self._load(symbol)
+        if series is None or not len(series[1]):
+            return None
+        return round(float(series[1][-1]), 2)
+
+    @metrics.timed(metrics.market_data_seconds, provider='replay', call='prices')
+    def prices(self, symbols):
+        self._wait()
+        prices = {}
+        for symbol in symbols:
+            series = self._load(symbol)
+            if series is not None and len(series[1]):
+                prices[symbol] = round(float(series[1][-1]), 2)
+        return prices
+
+    @metrics.timed(metrics.market_data_seconds, provider='replay', call='history')
+    def history(self, symbols, start):
+        import numpy as np
+
+        self._wait()
+        start = np.datetime64(str(start), 'D')
+        result = {}
+        for symbol in symbols:
+            series = self._load(symbol)
+            if series is None:
+                continue
+            dates, closes = series
+            first = np.searchsorted(dates, start)
+            result[symbol] = (dates[first:].copy(), closes[first:].copy())
+        return result
+
+    @metrics.timed(metrics.market_data_seconds, provider='replay', call='info')
+    def info(self, symbol):
+        self._wait()
+        if symbol in self._names:
+            return dict(self._names[symbol])
+        if self._load(symbol) is None:
+            return None
+        return {'short_name': f'{symbol.title()} Corp', 'exchange': 'NMS', 'currency': 'USD'}
+
+    def _wait(self):
+        if self.latency:
+            threading.Event().wait(self.latency)
+
+    def _load(self, symbol):
+        # (dates, closes) of symbol, None if it is unknown
+        with self._lock:
+            if symbol in self._series:
+                return self._series[symbol]
+
+        series = self._read(symbol)
+        if series is None and re.fullmatch(r'[A-Z]{1,5}', symbol):
+            series = self._synthesize(symbol)
+
+        with self._lock:
+            self._series[symbol] = series
+        return series
+
+    def _read(self, symbol):
+        if not self.directory:
+            return None
+        path = os.path.join(self.directory, symbol + '.csv')
+        if not os.path.exists(path):
+            return None
+
+        import numpy as np
+        import pandas as pd
+
+        data = pd.read_csv(path, parse_dates=['Date']).dropna()
+        return (data['Date'].values.astype('datetime64[D]'),
+                data['Adj Close'].to_numpy(np.float64))
+
+    def _synthesize(self, symbol):
+        import numpy as np
+
+        dates = np.arange(np.datetime64(self.epoch), np.datetime64(date.today(), 'D') + 1)
+        dates = dates[np.is_busday(dates)]
+
+        # drift, volatility and today's price all follow from the symbol;
+        # the walk is anchored at its end so current prices stay realistic
+        rng = np.random.default_rng(zlib.crc32(symbol.encode()))
+        drift = rng.uniform(0, 0.15) / 252
+        volatility = rng.uniform(0.15, 0.4) / np.sqrt(252)
+        steps = np.cumsum(rng.normal(drift - volatility ** 2 / 2, volatility, len(dates)))
+        closes = rng.uniform(10, 300) * np.exp(steps - steps[-1])
+        return dates, closes.round(4)
+
+
+def record(directory, symbols, start, source=None):
+    """Save history and names of symbols from source (default Yahoo) as replay fixtures"""
+    import pandas as pd
+
+    source = source or YahooProvider()
+    os.makedirs(directory, exist_ok=True)
+
+    names = {}
+    for symbol, (dates, closes) in source.history(symbols, start).items():
+        pd.DataFrame({'Date': dates, 'Adj Close': closes}).to_csv(
+            os.path.join(directory, symbol + '.csv'), index=False)
+        info = source.info(symbol)
+        if info is not None:
+            names[symbol] = info
+
+    with open(os.path.join(directory, 'symbols.json'), 'w') as f:
+        json.dump(names, f, indent=2)
+
+
+def from_env():
+    """The provider selected by MARKET_DATA (yahoo or replay)"""
+    kind = os.getenv("MARKET_DATA", "yahoo")
+    if kind == 'replay':
+        return ReplayProvider(os.getenv("MARKET_DATA_DIR"),
+                              latency=float(os.getenv("MARKET_DATA_LATENCY", 0)))
+    if kind == 'yahoo':
+        return YahooProvider()
+    raise ValueError(f'Unknown MARKET_DATA provider {kind}')
+
+
+# process-wide provider
+provider = from_env()
@@ -0,0 +1,200 @@
+import bisect
+import functools
+import hmac
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+import psycopg2.extensions
+
+from flask import Response, g, has_request_context, request
+
+
+# Prometheus-style metrics kept in process memory and rendered in the text
+# exposition format on /metrics. Recording is a lock, a bisect and two
+# additions, so instrumentation is cheap when the app is busy and free when
+# it is idle. With several worker processes each one reports its own.
+
+# latency buckets in seconds, from a cache hit to a slow optimisation
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    """Bucketed observations (cumulative on output) with their count and sum, per label set"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one slot per bucket, then +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time of a with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        for key, counts in sorted(values.items()):
+            labels = dict(zip(self.labels, key))
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts[:-1]):
+                total += count
+                yield self.name + '_bucket', dict(labels, le=str(bound)), total
+            yield self.name + '_count', labels, total
+            yield self.name + '_sum', labels, counts[-1]
+
+
+REGISTRY = []
+
+
+def histogram(name, help, labels=(), buckets=BUCKETS):
+    metric = Histogram(name, help, labels, buckets)
+    REGISTRY.append(metric)
+    return metric
+
+
+def timed(metric, **labels):
+    """Decorator observing every call of a function in histogram metric"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with metric.time(**labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render():
+    """Every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, labels, value in metric.samples():
+            if labels:
+                pairs = ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+                name = f'{name}{{{pairs}}}'
+            lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# the metrics the app records
+
+http_request_seconds = histogram(
+    'http_request_duration_seconds', 'Time to handle a request, by route', ('method', 'route', 'status'))
+http_request_queries = histogram(
+    'http_request_db_queries', 'Database statements executed per request, by route', ('route',),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+db_query_seconds = histogram(
+    'db_query_duration_seconds', 'Time to execute one database statement', ('operation',))
+quote_lookup_seconds = histogram(
+    'quote_lookup_duration_seconds', 'Time for helpers.lookup and lookup_many, cache hits included', ('call',))
+market_data_seconds = histogram(
+    'market_data_duration_seconds', 'Time of each call to the market data provider', ('provider', 'call'))
+optimise_stage_seconds = histogram(
+    'optimise_stage_duration_seconds', 'Time of each optimisation stage', ('stage',))
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """psycopg2 connection whose cursors, of any cursor_factory, time every execute"""
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _instrumented(factory)
+        return super().cursor(*args, **kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def _instrumented(factory):
+    # one timing subclass per cursor class (plain, RealDictCursor, ...)
+    class Cursor(factory):
+        def execute(self, query, vars=None):
+            with db_query_seconds.time(operation=_operation(query)):
+                result = super().execute(query, vars)
+            _count_query()
+            return result
+
+        def executemany(self, query, vars_list):
+            with db_query_seconds.time(operation=_operation(query)):
+                result = super().executemany(query, vars_list)
+            _count_query()
+            return result
+
+    Cursor.__name__ = 'Instrumented' + factory.__name__
+    return Cursor
+
+
+def _operation(query):
+    # first keyword of the statement (SELECT, INSERT, WITH, ...) as a cheap label
+    if not isinstance(query, (str, bytes)):
+        return 'OTHER'
+    words = query.split(None, 1)
+    if not words:
+        return 'OTHER'
+    word = words[0].upper()
+    if isinstance(word, bytes):
+        word = word.decode('ascii', 'replace')
+    return word if word.isalpha() else 'OTHER'
+
+
+def _count_query():
+    if has_request_context():
+        g.db_queries = g.get('db_queries', 0) + 1
+
+
+def init_app(app):
+    """Time every request and serve /metrics"""
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            # the URL rule, not the path, so job ids and chart keys share a series
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            http_request_seconds.observe(time.perf_counter() - started, method=request.method,
+                                         route=route, status=response.status_code)
+            http_request_queries.observe(g.pop('db_queries', 0), route=route)
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        """Every metric of this process in the Prometheus text format"""
+        # with METRICS_TOKEN set, scrapers must send it as a bearer token
+        token = os.getenv("METRICS_TOKEN")
+        if token and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+            return Response("Unauthorized\n", status=401, mimetype="text/plain")
+
+        response = Response(render(), mimetype='text/plain; version=0.0.4')
+        response.headers["Cache-Control"] = "no-store"
+        return response
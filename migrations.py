@@ -0,0 +1,132 @@
+from datetime import datetime
+
+
+# (version, description, sql) - append new migrations, never edit applied ones
+MIGRATIONS = [
+    (1, "create users, transactions and balance", """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY NOT NULL,
+            username TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            cash NUMERIC NOT NULL DEFAULT 10000.00
+        );
+
+        CREATE TABLE IF NOT EXISTS transactions (
+            transaction_id SERIAL PRIMARY KEY NOT NULL,
+            user_id INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            symbol TEXT NOT NULL,
+            shares INTEGER NOT NULL,
+            price REAL NOT NULL,
+            datetime TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+
+        CREATE TABLE IF NOT EXISTS balance (
+            user_id INTEGER NOT NULL,
+            symbol TEXT NOT NULL,
+            shares INTEGER NOT NULL,
+            total_value REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+    """),
+    (2, "create symbols", """
+        CREATE TABLE IF NOT EXISTS symbols (
+            symbol TEXT PRIMARY KEY NOT NULL,
+            short_name TEXT NOT NULL,
+            exchange TEXT,
+            currency TEXT,
+            refreshed_at TIMESTAMP NOT NULL
+        );
+    """),
+    (3, "keys and indexes for users, transactions and balance", """
+        -- merge any duplicate positions before the key goes on
+        WITH merged AS (
+            DELETE FROM balance RETURNING *
+        )
+        INSERT INTO balance (user_id, symbol, shares, total_value)
+        SELECT user_id, symbol, SUM(shares), SUM(total_value)
+        FROM merged
+        GROUP BY user_id, symbol;
+
+        ALTER TABLE balance ADD PRIMARY KEY (user_id, symbol);
+        CREATE INDEX transactions_user_id ON transactions (user_id);
+        CREATE UNIQUE INDEX users_username ON users (username);
+    """),
+    (4, "index for keyset-paginated history", """
+        CREATE INDEX transactions_user_id_datetime ON transactions (user_id, datetime DESC, transaction_id DESC);
+        DROP INDEX transactions_user_id;
+    """),
+    (5, "create jobs", """
+        CREATE TABLE jobs (
+            id TEXT PRIMARY KEY NOT NULL,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL,
+            progress REAL NOT NULL DEFAULT 0,
+            message TEXT,
+            params JSONB NOT NULL,
+            result JSONB,
+            error TEXT,
+            created_at TIMESTAMP NOT NULL,
+            finished_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+
+        CREATE INDEX jobs_user_id ON jobs (user_id, kind, created_at DESC);
+    """),
+    (6, "create valuations", """
+        -- the primary key doubles as the index for a user's value over time
+        CREATE TABLE valuations (
+            user_id INTEGER NOT NULL,
+            day DATE NOT NULL,
+            holdings NUMERIC NOT NULL,
+            cash NUMERIC NOT NULL,
+            PRIMARY KEY (user_id, day),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+    """),
+    (7, "create sessions", """
+        CREATE TABLE sessions (
+            id TEXT PRIMARY KEY NOT NULL,
+            data TEXT NOT NULL,
+            expires_at TIMESTAMP NOT NULL
+        );
+
+        CREATE INDEX sessions_expires_at ON sessions (expires_at);
+    """),
+    (8, "track job owners", """
+        -- unfinished jobs whose owner stopped beating are failed, see jobs.JobQueue
+        ALTER TABLE jobs ADD COLUMN owner TEXT, ADD COLUMN heartbeat_at TIMESTAMP;
+
+        CREATE INDEX jobs_unfinished ON jobs (heartbeat_at) WHERE status IN ('queued', 'running');
+    """),
+]
+
+
+def migrate(connection):
+    """Apply every migration the database has not seen yet, in order"""
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY NOT NULL,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP NOT NULL
+                );
+            """)
+
+    for version, description, sql in MIGRATIONS:
+        # one transaction per migration; the advisory lock keeps workers
+        # that start at the same time from applying it twice
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'));")
+                cursor.execute("SELECT 1 FROM schema_migrations WHERE version = %s;", [version])
+                if cursor.rowcount:
+                    continue
+                cursor.execute(sql)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, description, applied_at) VALUES (%s, %s, %s);",
+                    [version, description, datetime.now()]
+                )
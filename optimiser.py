@@ -0,0 +1,275 @@
+import os
+import time
+
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# Portfolio Opt
+from pypfopt.discrete_allocation import DiscreteAllocation, get_latest_prices
+
+import backtest
+import frontier
+import metrics
+import montecarlo
+import strategies
+from jobs import JobError
+from cache import TTLCache
+from charts import store as chart_store
+from history_store import store as history_store
+from universe import universe
+
+
+# estimates shared by every user with the same basket and window
+estimate_cache = TTLCache(
+    maxsize=int(os.getenv("ESTIMATE_CACHE_SIZE", 256)),
+    ttl=float(os.getenv("ESTIMATE_CACHE_TTL", 24 * 60 * 60)),
+)
+
+
+def optimise_portfolio(params, progress=None):
+    """
+    Markowitz mean-variance optimisation of a user's holdings.
+
+    params holds the starting `year`, the user's `stocks` (symbol, shares,
+    total_value) and optionally the `objective`, `estimator` and `target`
+    volatility (see strategies) and a `horizon` in years to project over.
+    progress(fraction, message) is called between stages. Returns a
+    JSON-serialisable dict with the new weights and share counts, the
+    leftover cash, the portfolio value, the comparison chart, the projection
+    (None without a horizon) and the wall time of each stage.
+    """
+    if progress is None:
+        progress = lambda fraction, message: None
+
+    stocks = params['stocks']
+    objective = params.get('objective', 'max_sharpe')
+    estimator = params.get('estimator', 'sample')
+    target = params.get('target')
+    timings = Timings()
+
+    list_of_tickers = []
+    total_total = 0
+    for stock in stocks:
+        ticker = stock['symbol'].upper()
+        total_value = stock['total_value'] # shares * (current) price
+        total_total += total_value # total_value of all portfolio
+        list_of_tickers.append(ticker)
+
+    # now all the stock names that the users holds should be in the tickers list
+    # get the adj close price since the chosen year
+    progress(0.1, 'Loading price history')
+    year = str(params['year'])+'-1-1'
+    with timings.stage('data'):
+        data = history_store.window(list_of_tickers, year)
+    # this should be a dataframe with the date as the index, tickers as columns and adj close as the values
+
+    progress(0.3, 'Estimating returns and covariance')
+    with timings.stage('estimation'):
+        mu, S = estimate_risk(data, year, estimator)
+
+    progress(0.5, 'Optimising weights')
+    with timings.stage('solve'):
+        try:
+            clean_weights = optimal_weights(data, year, mu, S, objective, estimator, target)
+        except strategies.StrategyError as error:
+            raise JobError(str(error))
+
+    # convert the OrderedDict to a pandas Series
+    series = pd.Series(clean_weights)
+
+    # turn weights into a number of shares
+    # get total value of current portfolio
+    progress(0.7, 'Allocating shares')
+    with timings.stage('allocation'):
+        pf_value = 0
+        for stock in stocks:
+            pf_value += stock['total_value']
+
+        latest_prices = get_latest_prices(data)
+        da = DiscreteAllocation(clean_weights, latest_prices, total_portfolio_value=pf_value)
+        allocation, leftover = da.greedy_portfolio()
+
+    display_stocks = []
+    for ticker in list_of_tickers:
+        symbol = ticker
+        weight = series[ticker]
+        if ticker in allocation:
+            num = allocation[ticker]
+        else:
+            num = 0
+        display_stocks.append({'symbol': symbol,
+                            'weight': float(weight),
+                            'shares': int(num),
+                            })
+
+    # Visualization (Historical Performance of Portfolio ignoring purchase day etc.)
+    progress(0.8, 'Backtesting')
+
+    # old weights from the current holdings, new weights from the optimiser
+    old_weights = [float(stock['total_value']) / float(total_total) for stock in stocks]
+    new_weights = [clean_weights.get(ticker, 0) for ticker in list_of_tickers]
+
+    # backtest both portfolios in one go
+    with timings.stage('backtest'):
+        result = backtest.run(data[list_of_tickers].to_numpy(), [old_weights, new_weights])
+
+    progress(0.9, 'Saving chart')
+    with timings.stage('chart'):
+        chart = chart_store.save({
+            'title': 'Comparison',
+            'xlabel': 'Date',
+            'ylabel': 'Cumulative Returns',
+            'dates': [str(day.date()) for day in data.index],
+            'lines': [{'label': 'Old Portfolio', 'values': result.growth[:, 0].round(6).tolist()},
+                      {'label': 'Optimised Portfolio', 'values': result.growth[:, 1].round(6).tolist()}],
+        })
+
+    # forward projection over the user's horizon
+    projection = None
+    if params.get('horizon'):
+        progress(0.95, 'Simulating the horizon')
+        with timings.stage('simulation'):
+            projection = project(data.index[-1],
+                                 mu.reindex(list_of_tickers),
+                                 S.reindex(index=list_of_tickers, columns=list_of_tickers),
+                                 [old_weights, new_weights], params['horizon'])
+
+    return {'display_stocks': display_stocks,
+            'allocation': {ticker: int(num) for ticker, num in allocation.items()},
+            'leftover': float(leftover),
+            'pf_value': float(pf_value),
+            'chart': chart,
+            'objective': objective,
+            'estimator': estimator,
+            'projection': projection,
+            'timings': timings}
+
+
+# simulated paths per projection
+MONTE_CARLO_PATHS = int(os.getenv("MONTE_CARLO_PATHS", 10000))
+
+
+def project(last, mu, S, weights, horizon, paths=MONTE_CARLO_PATHS):
+    """
+    Monte Carlo projection of the old and new portfolio over horizon years.
+
+    Returns the fan chart key, the growth of 1 unit at each percentile at
+    the horizon and the probability of ending with a loss, per portfolio.
+    """
+    result = montecarlo.simulate(mu.to_numpy(), S.to_numpy(), weights, horizon, paths=paths)
+
+    # checkpoints are trading days after the last close
+    dates = np.busday_offset(np.datetime64(last.date(), 'D'), result.days, roll='forward')
+    labels = ['Old Portfolio', 'Optimised Portfolio']
+    median = result.percentiles.index(50)
+
+    chart = chart_store.save({
+        'title': f'{horizon} Year Projection ({paths} paths)',
+        'xlabel': 'Date',
+        'ylabel': 'Growth of 1',
+        'dates': [str(day) for day in dates],
+        'lines': [{'label': f'{label} (median)', 'values': result.bands[i, median].round(6).tolist()}
+                  for i, label in enumerate(labels)],
+        'bands': [{'label': f'{label} ({result.percentiles[0]}-{result.percentiles[-1]}%)',
+                   'lower': result.bands[i, 0].round(6).tolist(),
+                   'upper': result.bands[i, -1].round(6).tolist()}
+                  for i, label in enumerate(labels)],
+    })
+
+    return {'horizon': horizon,
+            'paths': paths,
+            'chart': chart,
+            'percentiles': result.percentiles,
+            'final': [result.bands[i, :, -1].round(4).tolist() for i in range(len(labels))],
+            'prob_loss': [float(p) for p in result.prob_loss]}
+
+
+def efficient_frontier(params, points=50):
+    """
+    Risk/return frontier for a user's holdings, with the user's current
+    portfolio and (when there is one) the max-Sharpe portfolio placed on it.
+
+    params is the same as for optimise_portfolio.
+    """
+    stocks = params['stocks']
+    list_of_tickers = [stock['symbol'].upper() for stock in stocks]
+
+    year = str(params['year'])+'-1-1'
+    data = history_store.window(list_of_tickers, year)
+    if data.empty:
+        raise strategies.StrategyError(f"No price history for these stocks since {params['year']}")
+
+    mu_series, S_frame = estimate_risk(data, year)
+    mu = mu_series.reindex(list_of_tickers).to_numpy()
+    S = S_frame.reindex(index=list_of_tickers, columns=list_of_tickers).to_numpy()
+
+    total_total = sum(stock['total_value'] for stock in stocks)
+    old_weights = [stock['total_value'] / total_total for stock in stocks]
+    current = frontier.portfolio_point(old_weights, mu, S)
+
+    result = {'tickers': list_of_tickers,
+              'curve': frontier.sweep(mu, S, points),
+              'current': {'volatility': current[0], 'return': current[1]}}
+
+    # there is no max-Sharpe portfolio when no stock beats the risk-free
+    # rate; the rest of the frontier is still worth showing
+    try:
+        clean_weights = optimal_weights(data, year, mu_series, S_frame)
+    except strategies.StrategyError:
+        return result
+
+    new_weights = [clean_weights.get(ticker, 0) for ticker in list_of_tickers]
+    max_sharpe = frontier.portfolio_point(new_weights, mu, S)
+    result['max_sharpe'] = {'volatility': max_sharpe[0], 'return': max_sharpe[1]}
+    return result
+
+
+def estimate(data, start, objective='max_sharpe', estimator='sample', target=None):
+    """Expected returns, covariance and clean weights for a price history"""
+    mu, S = estimate_risk(data, start, estimator)
+    return mu, S, optimal_weights(data, start, mu, S, objective, estimator, target)
+
+
+def estimate_risk(data, start, estimator='sample'):
+    """
+    Expected returns and covariance for a price history.
+
+    Memoized on (tickers, start, last market date, estimator): users with the
+    same basket share one estimate, and the next trading day's data gets a
+    new key so stale results simply age out of the cache.
+    """
+    key = ('risk', tuple(sorted(data.columns)), start, str(data.index[-1].date()), estimator)
+    return estimate_cache.get_or_load(key, lambda: _estimate_risk(data, start, estimator))
+
+
+def _estimate_risk(data, start, estimator):
+    # slice the precomputed universe when it is up to date
+    if estimator == 'sample':
+        sliced = universe.slice(list(data.columns), start, data.index.values)
+        if sliced is not None:
+            return sliced
+
+    return strategies.estimate_risk(data, estimator)
+
+
+def optimal_weights(data, start, mu, S, objective='max_sharpe', estimator='sample', target=None):
+    """Clean weights for objective, memoized like estimate_risk plus objective and target"""
+    key = ('weights', tuple(sorted(data.columns)), start, str(data.index[-1].date()),
+           estimator, objective, target)
+    return estimate_cache.get_or_load(key, lambda: strategies.solve(mu, S, objective, target))
+
+
+class Timings(dict):
+    """Wall time in seconds of each stage of a computation"""
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self[name] = round(self.get(name, 0) + elapsed, 4)
+            metrics.optimise_stage_seconds.observe(elapsed, stage=name)
@@ -0,0 +1,112 @@
+import os
+import queue
+import threading
+import traceback
+
+import helpers
+
+
+class Subscription:
+    """One client's view of the feed: the symbols it watches and its pending updates"""
+
+    def __init__(self, symbols, backlog=16):
+        self.symbols = frozenset(symbol.upper() for symbol in symbols)
+        self._updates = queue.Queue(maxsize=backlog)
+
+    def get(self, timeout=None):
+        """Next dict of symbol -> price, raises queue.Empty after timeout"""
+        return self._updates.get(timeout=timeout)
+
+    def put(self, updates):
+        # a client that stopped reading misses updates instead of piling them up
+        try:
+            self._updates.put_nowait(updates)
+        except queue.Full:
+            pass
+
+
+class PriceFeed:
+    """
+    Live prices for every symbol somebody is watching, from one shared poller.
+
+    A single background thread fetches the union of all subscribed symbols
+    every `interval` seconds, in batches of `batch_size` per download, and
+    pushes the prices that changed to each subscriber watching them. Upstream
+    load therefore grows with the number of distinct symbols, not with the
+    number of viewers. The thread starts with the first subscriber and stops
+    once the last one has left.
+    """
+
+    def __init__(self, interval=15, batch_size=100):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._subscriptions = set()
+        self._prices = {}
+        self._thread = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def subscribe(self, symbols):
+        """Start watching symbols; the last known prices are queued right away"""
+        subscription = Subscription(symbols)
+
+        with self._lock:
+            self._subscriptions.add(subscription)
+            known = {symbol: self._prices[symbol]
+                     for symbol in subscription.symbols if symbol in self._prices}
+
+            # symbols nobody watched yet are fetched without waiting a full interval
+            if len(known) < len(subscription.symbols):
+                self._wake.set()
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='pricefeed', daemon=True)
+                self._thread.start()
+
+        if known:
+            subscription.put(known)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._subscriptions:
+                    # forget prices nobody watches, the next subscriber refetches
+                    self._thread = None
+                    self._prices.clear()
+                    return
+                symbols = sorted(set().union(*(s.symbols for s in self._subscriptions)))
+
+            self._wake.clear()
+            changed = {}
+            for first in range(0, len(symbols), self.batch_size):
+                try:
+                    prices = helpers.refresh_prices(symbols[first:first + self.batch_size])
+                except Exception:
+                    # keep the feed alive, the batch is retried on the next tick
+                    traceback.print_exc()
+                    continue
+                for symbol, price in prices.items():
+                    if self._prices.get(symbol) != price:
+                        changed[symbol] = price
+
+            with self._lock:
+                self._prices.update(changed)
+                subscriptions = list(self._subscriptions)
+
+            for subscription in subscriptions:
+                updates = {symbol: price for symbol, price in changed.items()
+                           if symbol in subscription.symbols}
+                if updates:
+                    subscription.put(updates)
+
+            self._wake.wait(self.interval)
+
+
+# process-wide feed shared by every streaming client
+feed = PriceFeed(interval=float(os.getenv("PRICE_POLL_INTERVAL", 15)),
+                 batch_size=int(os.getenv("PRICE_POLL_BATCH", 100)))
@@ -0,0 +1,182 @@
+import hmac
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, request
+
+
+class Sampler:
+    """
+    Statistical profiler of one thread.
+
+    A background thread reads the target thread's current stack every
+    `interval` seconds through sys._current_frames and counts identical
+    stacks. Nothing is traced, so the profiled code runs at full speed apart
+    from the GIL switches to the sampler.
+    """
+
+    def __init__(self, thread_id=None, interval=0.005):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self.duration = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self._started
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                # outermost frame first, as flamegraphs expect
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def collapsed(self):
+        """Brendan Gregg's collapsed stack format, one `frame;frame;frame count` line per stack"""
+        lines = []
+        for stack, count in self.stacks.most_common():
+            frames = ';'.join(f'{name} ({_short(filename)}:{line})' for name, filename, line in stack)
+            lines.append(f'{frames} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def speedscope(self, name):
+        """A speedscope (https://www.speedscope.app) sampled profile as a dict"""
+        frames = {}
+        samples = []
+        weights = []
+        for stack, count in self.stacks.items():
+            samples.append([frames.setdefault(frame, len(frames)) for frame in stack])
+            weights.append(count * self.interval)
+
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': name,
+            'exporter': 'profiler.py',
+            'shared': {'frames': [{'name': frame_name, 'file': filename, 'line': line}
+                                  for frame_name, filename, line in frames]},
+            'profiles': [{'type': 'sampled',
+                          'name': name,
+                          'unit': 'seconds',
+                          'startValue': 0,
+                          'endValue': sum(weights),
+                          'samples': samples,
+                          'weights': weights}],
+        }
+
+    def save(self, directory, name, formats=('collapsed', 'speedscope')):
+        """Write the profile to directory, returns the base file name"""
+        os.makedirs(directory, exist_ok=True)
+        base = '{}-{}-{}'.format(time.strftime('%Y%m%dT%H%M%S'),
+                                 re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_') or 'root',
+                                 uuid.uuid4().hex[:6])
+        if 'collapsed' in formats:
+            with open(os.path.join(directory, base + '.collapsed.txt'), 'w') as f:
+                f.write(self.collapsed())
+        if 'speedscope' in formats:
+            with open(os.path.join(directory, base + '.speedscope.json'), 'w') as f:
+                json.dump(self.speedscope(name), f)
+        return base
+
+
+# files under the app directory are shown relative to it
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def _short(filename):
+    # paths relative to the app or site-packages keep the flamegraph readable
+    for root in (ROOT, *sys.path[1:]):
+        if root and filename.startswith(root + os.sep):
+            return filename[len(root) + 1:]
+    return filename
+
+
+# where profiles go, how often to sample and which formats to write
+PROFILE_DIR = os.getenv("PROFILE_DIR", "data/profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))
+PROFILE_FORMATS = tuple(os.getenv("PROFILE_FORMATS", "collapsed,speedscope").split(","))
+
+# the admin secret that turns profiling on for one request, and the
+# fraction of all requests profiled without it
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+
+
+@contextmanager
+def sampling(name):
+    """Profile the current thread for the duration of a with block and save the result"""
+    sampler = Sampler(interval=PROFILE_INTERVAL).start()
+    try:
+        yield sampler
+    finally:
+        sampler.stop().save(PROFILE_DIR, name, PROFILE_FORMATS)
+
+
+def requested():
+    """Whether the current request asked for (or was picked for) profiling"""
+    if PROFILE_TOKEN:
+        token = request.headers.get("X-Profile") or request.args.get("_profile")
+        if token and hmac.compare_digest(token, PROFILE_TOKEN):
+            return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def active():
+    """Whether the current request is being profiled, e.g. to profile the job it queues too"""
+    return g.get('profile_sampler') is not None
+
+
+def init_app(app):
+    """Profile requests carrying the PROFILE_TOKEN, plus a PROFILE_SAMPLE_RATE share of all"""
+    if not PROFILE_TOKEN and not PROFILE_SAMPLE_RATE:
+        return
+
+    @app.before_request
+    def start_profile():
+        if requested():
+            g.profile_sampler = Sampler(interval=PROFILE_INTERVAL).start()
+
+    @app.after_request
+    def save_profile(response):
+        name = _finish()
+        if name is not None:
+            response.headers["X-Profile-File"] = name
+        return response
+
+    @app.teardown_request
+    def save_failed_profile(exception=None):
+        # a view that raised still leaves its profile behind
+        _finish()
+
+
+def _finish():
+    sampler = g.pop('profile_sampler', None)
+    if sampler is None:
+        return None
+    route = request.url_rule.rule if request.url_rule is not None else request.path
+    return sampler.stop().save(PROFILE_DIR, f'{request.method} {route}', PROFILE_FORMATS)
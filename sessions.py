@@ -0,0 +1,194 @@
+import os
+import secrets
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from flask import g
+from werkzeug.datastructures import CallbackDict
+
+import db
+
+
+# The session only holds user_id and flash messages. SESSION_BACKEND picks
+# where it lives:
+#   cookie      signed cookie (Flask's default), nothing stored server-side;
+#               the default when SECRET_KEY is set
+#   database    random id in the cookie, data in the sessions table
+#   filesystem  Flask-Session files, as before; one file read and write per
+#               request; the default without SECRET_KEY
+
+
+class DatabaseSession(CallbackDict, SessionMixin):
+    """Session dict that remembers its id, its expiry and whether it changed"""
+
+    def __init__(self, initial=None, sid=None, expires_at=None, stored=None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.stored = stored
+        self.new = sid is None
+        self.modified = False
+        self.rotate = False
+
+    def clear(self):
+        # login and logout clear the session; a new id afterwards means an id
+        # seen before login is worthless after it
+        super().clear()
+        self.rotate = True
+
+
+class DatabaseSessionInterface(SessionInterface):
+    """
+    Sessions in the sessions table, keyed by an unguessable id in the cookie.
+
+    A request reads its row once through a connection checked out just for
+    that, so requests that need no database hold none while they run.
+    Sessions whose data did not change (a flash shown in the request that
+    set it included) are not written back until half their lifetime has
+    passed, so most page views cost one indexed SELECT. Writes skip the
+    wait for the WAL flush: a session lost in a crash only means logging in
+    again. Expired rows are swept at most every `sweep_interval` seconds per
+    process (and by `flask sweep-sessions`), so the table does not grow
+    without bound.
+    """
+
+    serializer = session_json_serializer
+
+    def __init__(self, sweep_interval=3600):
+        self.sweep_interval = sweep_interval
+        self._last_sweep = time.monotonic()
+        self._lock = threading.Lock()
+
+    def open_session(self, app, request):
+        # static files never need the session
+        if request.path.startswith(f"{app.static_url_path}/"):
+            return self.make_null_session(app)
+
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            with _connection() as connection:
+                with connection:
+                    with connection.cursor() as cursor:
+                        cursor.execute(
+                            "SELECT data, expires_at FROM sessions WHERE id = %s AND expires_at > %s;",
+                            [sid, datetime.now()]
+                        )
+                        row = cursor.fetchone()
+            if row is not None:
+                return DatabaseSession(self.serializer.loads(row[0]), sid, row[1], row[0])
+        return DatabaseSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        # emptied, e.g. on logout: forget it on both sides
+        if not session:
+            if session.sid is not None and session.modified:
+                with _connection() as connection:
+                    with connection:
+                        with connection.cursor() as cursor:
+                            cursor.execute("DELETE FROM sessions WHERE id = %s;", [session.sid])
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        now = datetime.now()
+        lifetime = app.permanent_session_lifetime
+        data = self.serializer.dumps(dict(session))
+        unchanged = not session.rotate and data == session.stored
+        if unchanged and session.expires_at - now > lifetime / 2:
+            return
+
+        with _connection() as connection:
+            with connection:
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL synchronous_commit = off;")
+                    if session.rotate and session.sid is not None:
+                        cursor.execute("DELETE FROM sessions WHERE id = %s;", [session.sid])
+                    if session.rotate or session.sid is None:
+                        session.sid = secrets.token_urlsafe(32)
+                    cursor.execute(
+                        """INSERT INTO sessions (id, data, expires_at) VALUES (%s, %s, %s)
+                           ON CONFLICT (id) DO UPDATE SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at;""",
+                        [session.sid, data, now + lifetime]
+                    )
+                    if self._sweep_due():
+                        sweep(cursor)
+
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    def _sweep_due(self):
+        with self._lock:
+            if time.monotonic() - self._last_sweep < self.sweep_interval:
+                return False
+            self._last_sweep = time.monotonic()
+            return True
+
+
+@contextmanager
+def _connection():
+    # the request's connection if its view already took one (saving happens
+    # after the view), otherwise one from the pool for just this block
+    if 'db' in g:
+        yield g.db
+    else:
+        with db.pool.connection() as connection:
+            yield connection
+
+
+def sweep(cursor):
+    """Delete expired sessions, returns how many"""
+    cursor.execute("DELETE FROM sessions WHERE expires_at <= %s;", [datetime.now()])
+    return cursor.rowcount
+
+
+def init_app(app, backend=None):
+    """
+    Install the session backend named by SESSION_BACKEND.
+
+    Without SESSION_BACKEND it is cookie when SECRET_KEY is set, and the
+    filesystem otherwise, so deploys from before SECRET_KEY still start.
+    """
+    if not app.config['SECRET_KEY']:
+        app.config['SECRET_KEY'] = os.getenv("SECRET_KEY")
+
+    backend = backend or os.getenv("SESSION_BACKEND")
+    if backend is None:
+        backend = 'cookie' if app.config['SECRET_KEY'] else 'filesystem'
+        if backend == 'filesystem':
+            app.logger.warning("SECRET_KEY is not set, sessions fall back to the filesystem; "
+                               "set SECRET_KEY to use signed cookies")
+
+    if backend == 'cookie':
+        if not app.config['SECRET_KEY']:
+            raise RuntimeError("SECRET_KEY must be set to sign session cookies")
+    elif backend == 'database':
+        app.session_interface = DatabaseSessionInterface(
+            sweep_interval=float(os.getenv("SESSION_SWEEP_INTERVAL", 3600)))
+    elif backend == 'filesystem':
+        from flask_session import Session
+
+        app.config['SESSION_TYPE'] = 'filesystem'
+        Session(app)
+    else:
+        raise ValueError(f'Unknown SESSION_BACKEND {backend}')
@@ -0,0 +1,91 @@
+# Risk estimators and optimisation objectives selectable on /optimise.
+# Kept free of heavy imports at module level so the form can list the
+# choices without loading pypfopt; the functions import it when called.
+
+
+class StrategyError(ValueError):
+    """A strategy that can not be applied to this data, with a user-facing message"""
+
+
+# name -> label shown on the form
+ESTIMATORS = {
+    'sample': 'Sample covariance',
+    'ledoit_wolf': 'Ledoit-Wolf shrinkage',
+}
+
+OBJECTIVES = {
+    'max_sharpe': 'Maximum Sharpe ratio',
+    'min_volatility': 'Minimum volatility',
+    'efficient_risk': 'Maximum return at a target volatility',
+    'hrp': 'Hierarchical risk parity',
+}
+
+
+# annual rate the max-Sharpe objective measures excess returns against
+# (pypfopt's default)
+RISK_FREE_RATE = 0.02
+
+
+def estimate_risk(data, estimator):
+    """Annualised expected returns and covariance of a price history"""
+    from pypfopt import expected_returns, risk_models
+
+    mu = expected_returns.mean_historical_return(data)
+
+    if estimator == 'sample':
+        S = risk_models.sample_cov(data)
+    elif estimator == 'ledoit_wolf':
+        S = risk_models.CovarianceShrinkage(data).ledoit_wolf()
+    else:
+        raise StrategyError(f'Unknown estimator {estimator}')
+
+    return mu, S
+
+
+def solve(mu, S, objective, target=None):
+    """Clean weights (ticker -> weight) for objective given mu and S"""
+    from pypfopt import HRPOpt
+    from pypfopt.efficient_frontier import EfficientFrontier
+
+    # hierarchical risk parity only needs the covariance, no solver
+    if objective == 'hrp':
+        hrp = HRPOpt(cov_matrix=S)
+        hrp.optimize()
+        return hrp.clean_weights()
+
+    ef = EfficientFrontier(mu, S) # expected returns and covariance matrix as input
+
+    if objective == 'max_sharpe':
+        try:
+            ef.max_sharpe(risk_free_rate=RISK_FREE_RATE)
+        except ValueError:
+            # no asset is expected to beat the risk-free rate; retrying can't help
+            raise StrategyError(f'None of these stocks is expected to return more than the '
+                                f'{RISK_FREE_RATE:.0%} risk-free rate, so there is no maximum '
+                                f'Sharpe portfolio. Try another objective or starting year') from None
+    elif objective == 'min_volatility':
+        ef.min_volatility()
+    elif objective == 'efficient_risk':
+        if target is None:
+            raise StrategyError('A target volatility is required')
+        # the target is entered in percent, so report the floor in percent too
+        # (pypfopt's own message gives it as a fraction)
+        lowest = _min_volatility(S)
+        if target < lowest:
+            raise StrategyError(f'The lowest volatility these stocks can reach is {lowest:.1%}, '
+                                f'choose a target of at least that')
+        try:
+            ef.efficient_risk(target)
+        except ValueError as error:
+            raise StrategyError(str(error))
+    else:
+        raise StrategyError(f'Unknown objective {objective}')
+
+    return ef.clean_weights()
+
+
+def _min_volatility(S):
+    # volatility of the global minimum-variance portfolio, as pypfopt computes it
+    import numpy as np
+
+    return float(np.sqrt(1 / np.sum(np.linalg.pinv(np.asarray(S)))))
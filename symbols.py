@@ -0,0 +1,125 @@
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import psycopg2
+import psycopg2.extras
+
+import db
+import marketdata
+
+
+class SymbolStore:
+    """
+    Persistent symbol metadata (name, exchange, currency) with an in-memory mirror.
+
+    Names hardly ever change, so they are read from the mirror and only
+    refreshed in the background once older than `max_age`. Yahoo's slow
+    `info` endpoint is called synchronously only for symbols never seen before.
+    """
+
+    def __init__(self, max_age=timedelta(days=7)):
+        self.max_age = max_age
+        self.pool = None
+        self._mirror = {}
+        self._loaded = False
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def init_app(self, pool):
+        """
+        Bind the store to the connection pool; the mirror loads on first use.
+
+        Connections come from db.connection, so a lookup inside a request
+        shares the request's connection instead of taking a second one.
+        """
+        self.pool = pool
+
+    def load(self):
+        """(Re)load the mirror from the database"""
+        with db.connection() as connection:
+            with connection:
+                with connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                    cursor.execute("SELECT * FROM symbols;")
+                    rows = cursor.fetchall()
+
+        with self._lock:
+            self._mirror = {row['symbol']: row for row in rows}
+            self._loaded = True
+
+    def get(self, symbol):
+        """Return the metadata row for symbol, None if yahoo does not know it"""
+        symbol = symbol.upper()
+
+        if not self._loaded and self.pool is not None:
+            self.load()
+
+        with self._lock:
+            row = self._mirror.get(symbol)
+
+        # unknown symbol: this is the only time we wait on yahoo
+        if row is None:
+            return self.refresh(symbol)
+
+        # known but old: serve it anyway and refresh behind the request
+        if datetime.now() - row['refreshed_at'] > self.max_age:
+            self._refresh_later(symbol)
+
+        return row
+
+    def name(self, symbol):
+        """Short company name of symbol"""
+        row = self.get(symbol)
+        if row is None:
+            return None
+        return row['short_name']
+
+    def refresh(self, symbol):
+        """Fetch metadata for symbol from the market data provider and store it"""
+        symbol = symbol.upper()
+
+        info = marketdata.provider.info(symbol)
+        if info is None:
+            return None
+        row = dict(info, symbol=symbol, refreshed_at=datetime.now())
+
+        if self.pool is not None:
+            with db.connection() as connection:
+                with connection:
+                    with connection.cursor() as cursor:
+                        cursor.execute(
+                            """INSERT INTO symbols (symbol, short_name, exchange, currency, refreshed_at)
+                               VALUES (%(symbol)s, %(short_name)s, %(exchange)s, %(currency)s, %(refreshed_at)s)
+                               ON CONFLICT (symbol) DO UPDATE SET
+                                   short_name = EXCLUDED.short_name,
+                                   exchange = EXCLUDED.exchange,
+                                   currency = EXCLUDED.currency,
+                                   refreshed_at = EXCLUDED.refreshed_at;""",
+                            row
+                        )
+
+        with self._lock:
+            self._mirror[symbol] = row
+        return row
+
+    def _refresh_later(self, symbol):
+        # queue at most one background refresh per symbol
+        with self._lock:
+            if symbol in self._refreshing:
+                return
+            self._refreshing.add(symbol)
+
+        def task():
+            try:
+                self.refresh(symbol)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(symbol)
+
+        self._executor.submit(task)
+
+
+# process-wide store, bound to the database by app.py
+store = SymbolStore()
@@ -0,0 +1,176 @@
+from datetime import datetime
+
+
+class TradeError(Exception):
+    """An order that can not be executed, e.g. for lack of cash or shares"""
+
+
+# Each order is one round trip: lock the user row, then a single statement
+# whose data-modifying CTEs only fire when the cash or share check passes.
+
+_BUY = """
+    SELECT 1 FROM users WHERE id = %(user_id)s FOR UPDATE;
+
+    WITH u AS (
+        UPDATE users SET cash = cash - %(value)s
+        WHERE id = %(user_id)s AND cash >= %(value)s
+        RETURNING cash
+    ), t AS (
+        INSERT INTO transactions (user_id, action, symbol, shares, price, datetime)
+        SELECT %(user_id)s, 'purchase', %(symbol)s, %(shares)s, %(price)s, %(now)s FROM u
+    ), b AS (
+        INSERT INTO balance (user_id, symbol, shares, total_value)
+        SELECT %(user_id)s, %(symbol)s, %(shares)s, %(value)s FROM u
+        ON CONFLICT (user_id, symbol) DO UPDATE SET
+            shares = balance.shares + EXCLUDED.shares,
+            total_value = balance.total_value + EXCLUDED.total_value
+        RETURNING shares
+    )
+    SELECT (SELECT cash FROM u) AS cash,
+           (SELECT shares FROM b) AS shares;
+"""
+
+_SELL = """
+    SELECT 1 FROM users WHERE id = %(user_id)s FOR UPDATE;
+
+    WITH d AS (
+        DELETE FROM balance
+        WHERE user_id = %(user_id)s AND symbol = %(symbol)s AND shares = %(shares)s
+        RETURNING 0 AS shares
+    ), b AS (
+        UPDATE balance SET shares = shares - %(shares)s, total_value = total_value - %(value)s
+        WHERE user_id = %(user_id)s AND symbol = %(symbol)s AND shares > %(shares)s
+        RETURNING shares
+    ), p AS (
+        SELECT shares FROM d UNION ALL SELECT shares FROM b
+    ), t AS (
+        INSERT INTO transactions (user_id, action, symbol, shares, price, datetime)
+        SELECT %(user_id)s, 'sale', %(symbol)s, %(shares)s, %(price)s, %(now)s FROM p
+    ), u AS (
+        UPDATE users SET cash = cash + %(value)s
+        WHERE id = %(user_id)s AND EXISTS (SELECT 1 FROM p)
+        RETURNING cash
+    )
+    SELECT (SELECT cash FROM u) AS cash,
+           (SELECT shares FROM p) AS shares,
+           (SELECT shares FROM balance WHERE user_id = %(user_id)s AND symbol = %(symbol)s) AS held;
+"""
+
+
+# A rebalance is a basket of orders in one round trip as well: the target
+# positions arrive as arrays, the orders are their difference to `balance`,
+# and every write only fires when the net cost is covered by the cash.
+
+_REBALANCE = """
+    SELECT 1 FROM users WHERE id = %(user_id)s FOR UPDATE;
+
+    WITH target (symbol, shares, price) AS (
+        SELECT * FROM unnest(%(symbols)s::text[], %(shares)s::integer[], %(prices)s::numeric[])
+    ), orders AS (
+        SELECT target.symbol, target.shares, target.price,
+               target.shares - COALESCE(balance.shares, 0) AS delta,
+               COALESCE(balance.total_value, 0) AS total_value
+        FROM target
+        LEFT JOIN balance ON balance.user_id = %(user_id)s AND balance.symbol = target.symbol
+        WHERE target.shares <> COALESCE(balance.shares, 0)
+    ), u AS (
+        UPDATE users SET cash = cash - (SELECT COALESCE(SUM(delta * price), 0) FROM orders)
+        WHERE id = %(user_id)s AND cash >= (SELECT COALESCE(SUM(delta * price), 0) FROM orders)
+        RETURNING cash
+    ), t AS (
+        INSERT INTO transactions (user_id, action, symbol, shares, price, datetime)
+        SELECT %(user_id)s, CASE WHEN delta > 0 THEN 'purchase' ELSE 'sale' END,
+               symbol, abs(delta), price, %(now)s
+        FROM orders WHERE EXISTS (SELECT 1 FROM u)
+    ), d AS (
+        DELETE FROM balance
+        WHERE user_id = %(user_id)s AND EXISTS (SELECT 1 FROM u)
+          AND symbol IN (SELECT symbol FROM orders WHERE shares = 0)
+    ), b AS (
+        INSERT INTO balance (user_id, symbol, shares, total_value)
+        SELECT %(user_id)s, symbol, shares, total_value + delta * price
+        FROM orders WHERE shares > 0 AND EXISTS (SELECT 1 FROM u)
+        ON CONFLICT (user_id, symbol) DO UPDATE SET
+            shares = EXCLUDED.shares,
+            total_value = EXCLUDED.total_value
+    )
+    SELECT (SELECT cash FROM u) AS cash,
+           (SELECT count(*) FROM orders) AS orders;
+"""
+
+
+def buy(connection, user_id, symbol, shares, price):
+    """
+    Buy shares of symbol at price in a single transaction.
+
+    Returns the user's remaining cash and new position, raises TradeError
+    if the user can not afford the purchase.
+    """
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(_BUY, _order(user_id, symbol, shares, price))
+            cash, position = cursor.fetchone()
+
+    if cash is None:
+        raise TradeError('Insufficient cash funds')
+
+    return {'cash': float(cash), 'shares': position}
+
+
+def sell(connection, user_id, symbol, shares, price):
+    """
+    Sell shares of symbol at price in a single transaction.
+
+    Returns the user's new cash and remaining position, raises TradeError
+    if the user does not hold that many shares.
+    """
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(_SELL, _order(user_id, symbol, shares, price))
+            cash, position, held = cursor.fetchone()
+
+    if cash is None:
+        if not held:
+            raise TradeError('You do not own any of this stock')
+        raise TradeError('You do not own that many shares of this stock')
+
+    return {'cash': float(cash), 'shares': position}
+
+
+def rebalance(connection, user_id, targets, prices):
+    """
+    Trade the user's holdings to the target number of shares of each symbol
+    in a single transaction.
+
+    targets maps symbol -> shares wanted (0 sells the position) and prices
+    symbol -> price to trade at. Sales fund purchases; returns the user's
+    remaining cash and the number of orders executed, raises TradeError
+    if the basket costs more than the user's cash.
+    """
+    symbols = sorted(targets)
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(_REBALANCE, {
+                'user_id': user_id,
+                'symbols': [symbol.lower() for symbol in symbols],
+                'shares': [int(targets[symbol]) for symbol in symbols],
+                'prices': [float(prices[symbol]) for symbol in symbols],
+                'now': datetime.now(),
+            })
+            cash, orders = cursor.fetchone()
+
+    if cash is None:
+        raise TradeError('Insufficient cash funds')
+
+    return {'cash': float(cash), 'orders': orders}
+
+
+def _order(user_id, symbol, shares, price):
+    return {
+        'user_id': user_id,
+        'symbol': symbol.lower(),
+        'shares': shares,
+        'price': price,
+        'value': shares * price,
+        'now': datetime.now(),
+    }
@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pypfopt import expected_returns, risk_models
+
+import backtest
+import db
+from history_store import store as history_store
+
+
+class Universe:
+    """
+    Precomputed daily returns, expected returns and covariance for every held symbol.
+
+    One build per start date covers the union of all symbols in `balance` and
+    is stored as float32 .npy files that are memory-mapped on read. Both
+    estimators work column by column (pairwise for the covariance), so when
+    the build's trading days are exactly the user's, their mu and S are just
+    the matching rows and columns of the build. Symbols on another calendar
+    add days (zero returns for everyone else) and change both, so such users
+    get their own estimate instead.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._building = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def symbols(self):
+        """Union of all symbols held by any user"""
+        with db.pool.connection() as connection:
+            with connection:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT DISTINCT upper(symbol) FROM balance ORDER BY 1;")
+                    return [row[0] for row in cursor.fetchall()]
+
+    def starts(self):
+        """Start dates that have a build on disk"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name[:-len('.json')] for name in os.listdir(self.directory)
+                      if name.endswith('.json'))
+
+    def build(self, start, symbols=None):
+        """Build (or rebuild) the matrices for every held symbol since start"""
+        start = _start(start)
+        if symbols is None:
+            symbols = self.symbols()
+        if not symbols:
+            return
+
+        data = history_store.window(symbols, start)
+        symbols = list(data.columns)
+
+        returns = backtest.returns_from_prices(data.to_numpy()).astype(np.float32)
+        mu = expected_returns.mean_historical_return(data).reindex(symbols).to_numpy(np.float32)
+        cov = (risk_models.sample_cov(data)
+               .reindex(index=symbols, columns=symbols).to_numpy(np.float32))
+
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, start)
+        dates = data.index.values.astype('datetime64[D]')
+        for suffix, values in (('.dates.npy', dates), ('.returns.npy', returns),
+                               ('.mu.npy', mu), ('.cov.npy', cov)):
+            with open(base + suffix + '.tmp', 'wb') as f:
+                np.save(f, values)
+            os.replace(base + suffix + '.tmp', base + suffix)
+
+        # the metadata goes last: it is what marks the build as complete
+        meta = {'symbols': symbols,
+                'first': str(data.index[0].date()),
+                'last': str(data.index[-1].date())}
+        with open(base + '.json.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(base + '.json.tmp', base + '.json')
+
+    def slice(self, tickers, start, dates):
+        """
+        (mu, S) for tickers from the build for start, or None.
+
+        `dates` are the trading days of the user's price history. Returns None
+        (and queues a rebuild) when there is no build for start, it misses one
+        of the tickers, or it ends before the user's last day. Also returns
+        None, without a rebuild, when the build has days the user's symbols
+        do not trade on.
+        """
+        start = _start(start)
+        base = os.path.join(self.directory, start)
+        try:
+            with open(base + '.json') as f:
+                meta = json.load(f)
+            index = {symbol: i for i, symbol in enumerate(meta['symbols'])}
+            rows = [index[ticker] for ticker in tickers]
+            built = np.load(base + '.dates.npy', mmap_mode='r')
+        except (OSError, ValueError, KeyError):
+            self.build_later(start)
+            return None
+
+        dates = np.asarray(dates, dtype='datetime64[D]')
+        if meta['last'] < str(dates[-1]):
+            self.build_later(start)
+            return None
+        if not np.array_equal(built, dates):
+            return None
+
+        mu = np.load(base + '.mu.npy', mmap_mode='r')
+        cov = np.load(base + '.cov.npy', mmap_mode='r')
+
+        mu = pd.Series(mu[rows].astype(np.float64), index=tickers)
+        S = pd.DataFrame(cov[np.ix_(rows, rows)].astype(np.float64), index=tickers, columns=tickers)
+        return mu, risk_models.fix_nonpositive_semidefinite(S)
+
+    def build_later(self, start):
+        # queue at most one background build per start date
+        with self._lock:
+            if start in self._building or db.pool is None:
+                return
+            self._building.add(start)
+
+        def task():
+            try:
+                self.build(start)
+            finally:
+                with self._lock:
+                    self._building.discard(start)
+
+        self._executor.submit(task)
+
+
+def _start(value):
+    # '2018-1-1' and '2018-01-01' name the same build
+    return str(pd.Timestamp(value).date())
+
+
+# process-wide universe
+universe = Universe(os.getenv("UNIVERSE_DIR", "data/universe"))
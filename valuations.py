@@ -0,0 +1,82 @@
+from datetime import date
+
+import psycopg2.extras
+
+from helpers import lookup_many
+
+
+# One row per user per trading day. Every distinct held symbol is priced once
+# and a single set-based statement values all users from that price list, so
+# the batch costs one quote lookup per symbol and one round trip in total.
+
+_RECORD = """
+    INSERT INTO valuations (user_id, day, holdings, cash)
+    SELECT users.id, %(day)s,
+           -- a holding that could not be priced keeps its book value
+           COALESCE(SUM(COALESCE(balance.shares * prices.price, balance.total_value)), 0),
+           users.cash
+    FROM users
+    LEFT JOIN balance ON balance.user_id = users.id
+    LEFT JOIN unnest(%(symbols)s::text[], %(prices)s::numeric[]) AS prices (symbol, price)
+        ON prices.symbol = upper(balance.symbol)
+    GROUP BY users.id, users.cash
+    ON CONFLICT (user_id, day) DO UPDATE SET
+        holdings = EXCLUDED.holdings,
+        cash = EXCLUDED.cash;
+"""
+
+
+def snapshot(connection, day=None):
+    """
+    Record every user's holdings value and cash for day (default today).
+
+    Running it again for the same day overwrites that day's rows. Returns
+    the number of users valued.
+    """
+    if day is None:
+        day = date.today()
+
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT DISTINCT upper(symbol) FROM balance;")
+            symbols = [row[0] for row in cursor.fetchall()]
+
+    # price every symbol once, outside the transaction
+    quotes = lookup_many(symbols)
+    priced = [symbol for symbol in symbols if quotes.get(symbol) is not None]
+
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(_RECORD, {'day': day,
+                                     'symbols': priced,
+                                     'prices': [quotes[symbol]['price'] for symbol in priced]})
+            return cursor.rowcount
+
+
+def history(connection, user_id, since=None):
+    """A user's snapshots (day, holdings, cash, total) since a date, oldest first"""
+    with connection:
+        with connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute(
+                """SELECT day, holdings, cash, holdings + cash AS total
+                   FROM valuations
+                   WHERE user_id = %s AND day >= %s
+                   ORDER BY day;""",
+                [user_id, since or date.min]
+            )
+            return cursor.fetchall()
+
+
+def latest(connection, user_id, count=2):
+    """A user's most recent snapshots, newest first"""
+    with connection:
+        with connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute(
+                """SELECT day, holdings, cash, holdings + cash AS total
+                   FROM valuations
+                   WHERE user_id = %s
+                   ORDER BY day DESC
+                   LIMIT %s;""",
+                [user_id, count]
+            )
+            return cursor.fetchall()